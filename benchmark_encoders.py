@@ -0,0 +1,41 @@
+import argparse
+import numpy as np
+import cv2
+
+from encoders import measure_encoder, select_encoder
+
+# Set argument parser
+parser = argparse.ArgumentParser(description='benchmark_encoders')
+parser.add_argument('--images', type=str, nargs='*', default=[],
+                    help="Rectified orthophotos, e.g. the PNGs of a run. A random frame if not given")
+parser.add_argument('--encoders', type=str, nargs='+',
+                    default=["qoi", "png:1", "png:3", "png:6", "webp", "deflate:1", "deflate:3", "deflate:6",
+                             "zstd:3", "jpeg:90", "none"],
+                    help="name or name:level")
+parser.add_argument('--workers', type=int, default=0, help="Threads of the GeoTIFF encoders. 0 for the CPUs")
+parser.add_argument('--seconds', type=float, default=1., help="The latency target of the selection")
+parser.add_argument('--ratio', type=float, default=0, help="The size target of the selection, instead if > 0")
+parser.add_argument('--repeat', type=int, default=3)
+
+
+if __name__ == "__main__":
+    opt = parser.parse_args()
+
+    if opt.images:
+        orthophotos = [cv2.imread(image, -1) for image in opt.images]
+        orthophotos = [orthophoto.reshape(orthophoto.shape[0], orthophoto.shape[1], -1) for orthophoto in orthophotos]
+    else:
+        orthophotos = [np.random.randint(0, 256, size=(3000, 4000, 4), dtype=np.uint8)]
+
+    for name, orthophoto in zip(opt.images or ["random"], orthophotos):
+        mpix = orthophoto.shape[0] * orthophoto.shape[1] / 1e6
+        print(f"{name}: {orthophoto.shape} {orthophoto.dtype}")
+        for encoder in opt.encoders:
+            try:
+                seconds, size = measure_encoder(orthophoto, encoder, opt.workers, opt.repeat)
+            except ValueError as e:
+                print(f"{encoder:<12} {e}")
+                continue
+            print(f"{encoder:<12} {seconds:8.4f} sec  {mpix / seconds:8.2f} MPix/s  {size / orthophoto.nbytes:7.1%}")
+        selected, _ = select_encoder(orthophoto, opt.encoders, opt.seconds, opt.ratio, opt.workers)
+        print(f"Selected: {selected}")
@@ -0,0 +1,79 @@
+import argparse
+import time
+import numpy as np
+import cv2
+
+from dem import boundary, footprint
+from module import Rot3D
+from rectification import footprint_spans, rectify_plane_parallel, rectify_plane_f32, rectify_plane_homography, \
+    sample_alpha
+
+# Set argument parser
+parser = argparse.ArgumentParser(description='benchmark_rectification')
+parser.add_argument('--image', type=str, default="", help="An image to rectify. A random image if not given")
+parser.add_argument('--rows', type=int, default=3648, help="Rows of a random image")
+parser.add_argument('--cols', type=int, default=5472, help="Columns of a random image")
+parser.add_argument('--eo', type=float, nargs=6, default=[200000., 500000., 150., 0., 0., 30.],
+                    help="X(m) Y(m) Z(m) omega(deg) phi(deg) kappa(deg)")
+parser.add_argument('--focal_length', type=float, default=8.8, help="unit: mm")
+parser.add_argument('--pixel_size', type=float, default=2.41, help="unit: um")
+parser.add_argument('--ground_height', type=float, default=0.)
+parser.add_argument('--gsd', type=float, default=0.05, help="unit: m")
+parser.add_argument('--resampling', type=str, default="nearest", help="nearest, bilinear, bicubic, area")
+parser.add_argument('--repeat', type=int, default=5)
+
+
+def run(name, rectify, args, boundary_rows, boundary_cols, repeat):
+    # The first call includes JIT compilation
+    result = rectify(*args)
+    elapsed = np.empty(repeat)
+    for i in range(repeat):
+        start = time.time()
+        result = rectify(*args)
+        elapsed[i] = time.time() - start
+    mpix = boundary_rows * boundary_cols / 1e6
+    print(f"{name:<12} {np.median(elapsed):8.4f} sec  {mpix / np.median(elapsed):8.2f} MPix/s")
+
+    return result
+
+
+if __name__ == "__main__":
+    opt = parser.parse_args()
+
+    if opt.image:
+        image = cv2.imread(opt.image, -1)
+        image = image.reshape(image.shape[0], image.shape[1], -1)
+    else:
+        image = np.random.randint(0, 256, size=(opt.rows, opt.cols, 3), dtype=np.uint8)
+    eo = np.array(opt.eo, dtype=float)
+    R = Rot3D(eo * np.pi / 180)
+    focal_length = opt.focal_length / 1000
+    pixel_size = opt.pixel_size / 1000000
+    gsd = opt.gsd
+
+    bbox = boundary(image, eo, R, opt.ground_height, pixel_size, focal_length)
+    boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / gsd)
+    boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / gsd)
+    polygon = footprint(image, eo, R, opt.ground_height, pixel_size, focal_length)
+    spans = footprint_spans(polygon, bbox[0, 0], bbox[3, 0], gsd, boundary_rows, boundary_cols)
+    coverage = np.sum(spans[:, 1] - spans[:, 0]) / (boundary_rows * boundary_cols)
+    print(f"Image: {image.shape}, Orthophoto: {boundary_rows} x {boundary_cols}, Footprint spans: {coverage:.1%}")
+
+    args = (bbox, boundary_rows, boundary_cols, gsd, eo, opt.ground_height, R, focal_length, pixel_size, image,
+            spans)
+    distortion = np.empty(shape=(0, 0, 2), dtype=np.float32)  # a perfect pinhole
+    shape = (boundary_rows, boundary_cols, image.shape[2] + 1)
+    numba_result = run("numba", rectify_plane_parallel,
+                       args + (np.empty(shape, image.dtype), sample_alpha(image.dtype), distortion, opt.resampling),
+                       boundary_rows, boundary_cols, opt.repeat)
+    f32_result = run("numba f32", rectify_plane_f32,
+                     args + (np.empty(shape, image.dtype), sample_alpha(image.dtype), distortion, opt.resampling),
+                     boundary_rows, boundary_cols, opt.repeat)
+    homography_result = run("homography", rectify_plane_homography,
+                            args + (np.empty(shape, image.dtype), sample_alpha(image.dtype), distortion, opt.resampling),
+                            boundary_rows, boundary_cols, opt.repeat)
+
+    mismatch = np.count_nonzero(numba_result != f32_result)
+    print(f"Mismatched samples (numba vs numba f32): {mismatch}")
+    mismatch = np.count_nonzero(numba_result != homography_result)
+    print(f"Mismatched samples (numba vs homography): {mismatch}")
@@ -28,6 +28,8 @@ output_filepath = os.path.join(output_dir, output_filename)
 # load data using Python JSON module
 with open(input_file, 'r') as f:
     data = f.readlines()
+# Only the timings of the frames, not the surfaces chosen for them
+data = [line for line in data if " surface " not in line]
 
 processing_name = ["Georeferencing", "DEM", "Rectify", "Write", "Total"]
 processing_time = np.empty(shape=(len(data), 5))
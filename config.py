@@ -25,10 +25,46 @@ config = {
     "iterations": 500,              # The maximum iteration times of terrain simulation. 500 is enough for most of scenes.
     "class_threshold": 0.5,         # The distances between points and the simulated terrain. 0.5 is adapted to most of scenes.
     "time_step": 0.65,
+    "csf_tile_size": 0,             # Side of a tile of CSF in parallel in m. Set to 0 for about a tile per worker
+    "csf_overlap": 5.0,             # Points around a tile in m filtered along with it, for the cloth at its edges
+    "csf_workers": 0,               # Processes of CSF. Set to 0 for the number of cores
+    "label_cache": True,            # Keep the labels of voxels across frames, and classify only the new points
+    "label_voxel_size": 0.25,       # Voxel size of the label cache in m
+    "label_max_age": 3,             # Frames a voxel is kept in the label cache after it is last seen
 
     # Params for mapping
     "epsg": 5186,                   # Target coordinate system in EPSG
     "gsd": 0.1,                     # Target ground sampling distance in m. Set to 0 to disable
-    "dem": "plane",                 # Types of projection plane for indirect mapping (dsm, dtm, plane)
-    "ground_height": 0.0            # Target ground height in m
+    "dem": "auto",                  # Types of projection plane for indirect mapping (dsm, dtm, plane, auto)
+    "plane_tolerance": 1.0,         # Relief displacement in GSD within which auto chooses a plane
+    "object_height": 2.0,           # Height in m over the slope of a cell, of an object such as a building or a tree
+    "object_ratio": 0.1,            # Ratio of the cells of objects over which auto chooses a DSM, otherwise a DTM
+    "dem_interpolation": "raster",  # DEM from points by griddata (Delaunay, linear) or raster (binned per GSD cell)
+    "dem_resolution": 0.5,          # Grid spacing of the DEM in m, sampled bilinearly at the GSD. 0 for the GSD
+    "dem_statistic": "mean",        # Height of the points in a raster cell (min, mean, max, median)
+    "dem_incremental": True,        # Keep a tiled DEM across frames, and fold in only the new points (not median)
+    "dem_tile_size": 256,           # Cells of a side of a tile of the incremental DEM
+    "dem_store": "",                # Directory of the tiles of the incremental DEM kept across runs, "" in memory
+    "dem_coverage": 0.95,           # Ratio of the footprint in cells with points of the stored DEM to rectify on it
+    "voxel_size": 0,                # Downsample the points by voxel columns of this size in m. Set to 0 to disable
+    "point_budget": 200000,         # Enlarge the voxels until at most this many points remain. Set to 0 to disable
+    "dem_margin": 0.2,              # Margin around the footprint to crop the points to, in ratio of its size
+    "ground_height": 0.0,           # Target ground height in m
+    "plane_engine": "homography",   # Rectification engine for a flat projection plane (homography, numba)
+    "resampling": "nearest",        # Resampling method of orthophotos (nearest, bilinear, bicubic, area)
+    "strip_rows": 512,              # Rows of a strip to stream large orthophotos into TIFF. Set to 0 to disable
+    "max_frame_pixels": 200000000,  # Orthophotos of more pixels than this are streamed by strips
+    "write_queue": 2,               # Orthophotos waiting for the writer thread. Set to 0 to write in the main loop
+    "encoder": "png",               # png, webp, qoi (with a world file), deflate, zstd, jpeg, none (tiled GeoTIFF),
+                                    # as name:level e.g. png:1, or auto to select one of encoder_candidates per run
+                                    # webp and qoi aren't read as georeferenced by most GIS, zstd needs zstandard
+    "encoder_candidates": ["png:1", "png:3", "deflate:1", "deflate:3"],
+    "encoder_seconds": 1.0,         # auto: the smallest output of the candidates encoding a frame within this
+    "encoder_ratio": 0,             # auto: the fastest candidate within this ratio of the raw size, if > 0
+    "compression_workers": 0,       # Threads compressing the tiles of a GeoTIFF. 0 for the number of CPUs
+    "true_ortho": False,            # Hide the DEM cells occluded from an image by a depth buffer
+    "occlusion_tolerance": 0.5,     # Depth in m within which a DEM cell is visible in the depth buffer
+    "prefetch_depth": 2,            # Images decoded ahead with their EO sidecars in threads. Set to 0 to disable
+    "max_decode_scale": 8,          # JPEGs decoded at up to 1/2, 1/4 or 1/8 of their size for a coarser GSD. 1: off
+    "precision": "float64"          # Per-pixel math of the numba kernels (float64, float32 re-centred on the camera)
 }
@@ -2,14 +2,23 @@ import laspy
 import CSF
 import numpy as np
 from scipy.interpolate import griddata
+from scipy.spatial import ConvexHull
+from numba import jit, prange
 import time
+import os
+import atexit
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import open3d as o3d
 
+from rectification import footprint_spans
 
-def boundary(image, eo, R, dem, pixel_size, focal_length):
+
+def boundary(image, eo, R, dem, pixel_size, focal_length, margin=0):
     inverse_R = R.transpose()
 
-    image_vertex = getVertices(image, pixel_size, focal_length)  # shape: 3 x 4
+    image_vertex = getVertices(image, pixel_size, focal_length, margin)  # shape: 3 x 4
 
     proj_coordinates = projection(image_vertex, eo, inverse_R, dem)
 
@@ -22,9 +31,20 @@ def boundary(image, eo, R, dem, pixel_size, focal_length):
     return bbox
 
 
-def getVertices(image, pixel_size, focal_length):
-    rows = image.shape[0]
-    cols = image.shape[1]
+def footprint(image, eo, R, dem, pixel_size, focal_length, margin=1):
+    # Projected vertices of an image on the plane of height `dem`, enlarged by `margin` px
+    inverse_R = R.transpose()
+
+    image_vertex = getVertices(image, pixel_size, focal_length, margin)  # shape: 3 x 4
+
+    proj_coordinates = projection(image_vertex, eo, inverse_R, dem)  # shape: 2 x 4
+
+    return proj_coordinates
+
+
+def getVertices(image, pixel_size, focal_length, margin=0):
+    rows = image.shape[0] + 2 * margin
+    cols = image.shape[1] + 2 * margin
 
     # (1) ------------ (2)
     #  |     image      |
@@ -59,12 +79,17 @@ def projection(vertices, eo, rotation_matrix, dem):
     return plane_coord_GCS
 
 
-def cloth_simulation_filtering(xyz, bSloopSmooth=False, cloth_resolution=0.5):
+def cloth_simulation_filtering(xyz, slope_smooth=False, cloth_resolution=0.5, rigidness=3, iterations=500,
+                               class_threshold=0.5, time_step=0.65):
     csf = CSF.CSF()
 
     # prameter settings
-    csf.params.bSloopSmooth = bSloopSmooth
+    csf.params.bSloopSmooth = slope_smooth
     csf.params.cloth_resolution = cloth_resolution
+    csf.params.rigidness = rigidness
+    csf.params.interations = iterations     # sic
+    csf.params.class_threshold = class_threshold
+    csf.params.time_step = time_step
     # more details about parameter: http://ramm.bnu.edu.cn/projects/CSF/download/
 
     csf.setPointCloud(xyz)
@@ -72,11 +97,87 @@ def cloth_simulation_filtering(xyz, bSloopSmooth=False, cloth_resolution=0.5):
     non_ground = CSF.VecInt()  # a list to indicate the index of non-ground points after calculation
     csf.do_filtering(ground, non_ground)  # do actual filtering.
 
+    ground = np.array(ground, dtype=np.int64)
     filtered_xyz = xyz[ground]  # extract ground points
 
     return filtered_xyz, ground
 
 
+csf_executor = None     # worker processes of tiled_cloth_simulation_filtering, kept across frames
+
+
+def start_csf_workers(workers=0):
+    # Fork the worker processes of tiled_cloth_simulation_filtering, at startup before any thread runs,
+    # as a process forked from threads (numba's parallel kernels, the writer, the prefetcher) may hang at exit
+    # Forked, as spawned workers would run the main script again. workers: 0 for the number of cores
+    global csf_executor
+    workers = workers if workers > 0 else os.cpu_count()
+    if csf_executor is None and workers > 1:
+        csf_executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+        list(csf_executor.map(abs, range(workers)))     # the processes are forked on the first jobs
+        atexit.register(csf_executor.shutdown)
+
+    return csf_executor
+
+
+def csf_tile(xyz, core, csf_params):
+    # Ground labels of the points in the core of a tile, filtered along with the points of its overlap
+    _, ground = cloth_simulation_filtering(xyz, **csf_params)
+    labels = np.zeros(xyz.shape[0], dtype=bool)
+    labels[ground] = True
+    return labels[core]
+
+
+def tiled_cloth_simulation_filtering(xyz, tile_size=0, overlap=5., workers=0, **csf_params):
+    # CSF of the tiles of a cloud in parallel processes, each with `overlap` m of the points around it,
+    # so that the cloth at the edges of a tile lies as on the whole cloud
+    # A point takes the label of the tile whose core it is in
+    # tile_size: side of a tile in m, 0 for about a tile per worker. workers: 0 for the number of cores
+    # The workers are of start_csf_workers, without which the cloud is filtered as a whole
+    workers = workers if workers > 0 else os.cpu_count()
+    x_min, y_min = xyz[:, :2].min(axis=0)
+    width, height = xyz[:, :2].max(axis=0) - (x_min, y_min)
+    if tile_size <= 0:
+        tile_size = max(np.sqrt(width * height / workers), 4 * overlap)
+    tile_cols = int(width // tile_size) + 1
+    tile_rows = int(height // tile_size) + 1
+    if csf_executor is None or workers == 1 or tile_rows * tile_cols == 1:
+        return cloth_simulation_filtering(xyz, **csf_params)
+
+    tiles = ((xyz[:, 1] - y_min) // tile_size).astype(np.int64) * tile_cols + \
+            ((xyz[:, 0] - x_min) // tile_size).astype(np.int64)
+    jobs = []
+    for tile in np.unique(tiles):
+        x0 = x_min + (tile % tile_cols) * tile_size - overlap
+        y0 = y_min + (tile // tile_cols) * tile_size - overlap
+        points = np.flatnonzero((xyz[:, 0] >= x0) & (xyz[:, 0] < x0 + tile_size + 2 * overlap) &
+                                (xyz[:, 1] >= y0) & (xyz[:, 1] < y0 + tile_size + 2 * overlap))
+        core = tiles[points] == tile
+        jobs.append((points[core], csf_executor.submit(csf_tile, xyz[points], core, csf_params)))
+
+    labels = np.zeros(xyz.shape[0], dtype=bool)
+    for points, job in jobs:
+        labels[points] = job.result()
+    ground = np.flatnonzero(labels)
+
+    return xyz[ground], ground
+
+
+class DEM:
+    # A raster of heights z on the grid nodes (x_min + col * gsd, y_max - row * gsd)
+    # The coordinates of the nodes are not stored, but computed where they are needed from the geotransform
+    def __init__(self, z, x_min, y_max, gsd):
+        self.z = z
+        self.x_min = x_min
+        self.y_max = y_max
+        self.gsd = gsd
+
+    @property
+    def geotransform(self):
+        # In the order of GDAL: X origin, pixel width, row rotation, Y origin, column rotation, pixel height
+        return np.array([self.x_min, self.gsd, 0., self.y_max, 0., -self.gsd])
+
+
 def interpolate_dem(xyz, gsd, method='linear'):
     X_min = np.min(xyz[:, 0])
     X_max = np.max(xyz[:, 0])
@@ -87,13 +188,524 @@ def interpolate_dem(xyz, gsd, method='linear'):
     grid_y, grid_x = np.mgrid[Y_max:Y_min:-gsd, X_min:X_max:gsd]
     grid_z = griddata(xyz[:, 0:2], xyz[:, 2], (grid_x, grid_y), method=method)
 
-    bbox = np.array([X_min, X_max, Y_min, Y_max])
-
-    return grid_x, grid_y, grid_z, bbox
-
+    return DEM(grid_z, X_min, Y_max, gsd)
+
+
+@jit(nopython=True, cache=True)
+def cell_statistic(statistic):
+    if statistic == "min":
+        return 0
+    elif statistic == "mean":
+        return 1
+    elif statistic == "max":
+        return 2
+    elif statistic == "median":
+        return 3
+    raise ValueError("Unknown statistic, choose one of min, mean, max, median")
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def bin_points(xyz, x_min, y_max, gsd, rows, cols):
+    # Index of the nearest grid node (row * cols + col) of each point
+    cells = np.empty(xyz.shape[0], dtype=np.int64)
+    for i in prange(xyz.shape[0]):
+        row = min(max(int(np.floor((y_max - xyz[i, 1]) / gsd + 0.5)), 0), rows - 1)
+        col = min(max(int(np.floor((xyz[i, 0] - x_min) / gsd + 0.5)), 0), cols - 1)
+        cells[i] = row * cols + col
+    return cells
+
+
+@jit(nopython=True, cache=True)
+def sort_by_cell(cells, z, no_cells):
+    # Counting sort of the heights by cell: heights of cell k are in sorted_z[start[k]:start[k + 1]]
+    start = np.zeros(no_cells + 1, dtype=np.int64)
+    for i in range(cells.size):
+        start[cells[i] + 1] += 1
+    for k in range(no_cells):
+        start[k + 1] += start[k]
+
+    sorted_z = np.empty(z.size, dtype=z.dtype)
+    position = start[:-1].copy()
+    for i in range(cells.size):
+        sorted_z[position[cells[i]]] = z[i]
+        position[cells[i]] += 1
+    return sorted_z, start
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def reduce_cells(sorted_z, start, statistic="mean"):
+    # A height of each cell from its points, NaN for a cell without points
+    method = cell_statistic(statistic)
+    no_cells = start.size - 1
+    grid_z = np.full(no_cells, np.nan)
+    for k in prange(no_cells):
+        heights = sorted_z[start[k]:start[k + 1]]
+        if heights.size == 0:
+            continue
+        if method == 0:
+            grid_z[k] = heights.min()
+        elif method == 1:
+            grid_z[k] = heights.mean()
+        elif method == 2:
+            grid_z[k] = heights.max()
+        else:
+            grid_z[k] = np.median(heights)
+    return grid_z
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def pull(z, w):
+    # The coarser level of push-pull: weighted average of 2 x 2 cells, and their weight up to 1
+    rows = (z.shape[0] + 1) // 2
+    cols = (z.shape[1] + 1) // 2
+    coarse_z = np.zeros((rows, cols))
+    coarse_w = np.zeros((rows, cols))
+    for row in prange(rows):
+        for col in range(cols):
+            sum_z = 0.
+            sum_w = 0.
+            for i in range(2 * row, min(2 * row + 2, z.shape[0])):
+                for j in range(2 * col, min(2 * col + 2, z.shape[1])):
+                    sum_z += z[i, j] * w[i, j]
+                    sum_w += w[i, j]
+            if sum_w > 0:
+                coarse_z[row, col] = sum_z / sum_w
+            coarse_w[row, col] = min(sum_w, 1.)
+    return coarse_z, coarse_w
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def push(z, w, coarse_z):
+    # Blend the bilinear interpolation of the coarser level into the cells of weight below 1
+    rows = coarse_z.shape[0]
+    cols = coarse_z.shape[1]
+    for row in prange(z.shape[0]):
+        for col in range(z.shape[1]):
+            if w[row, col] >= 1:
+                continue
+            # The center of a cell on the coarser level
+            y = min(max((row + 0.5) / 2 - 0.5, 0.), rows - 1.)
+            x = min(max((col + 0.5) / 2 - 0.5, 0.), cols - 1.)
+            row0 = int(y)
+            col0 = int(x)
+            row1 = min(row0 + 1, rows - 1)
+            col1 = min(col0 + 1, cols - 1)
+            dy = y - row0
+            dx = x - col0
+            fill = (coarse_z[row0, col0] * (1 - dx) * (1 - dy) + coarse_z[row0, col1] * dx * (1 - dy) +
+                    coarse_z[row1, col0] * (1 - dx) * dy + coarse_z[row1, col1] * dx * dy)
+            z[row, col] = w[row, col] * z[row, col] + (1 - w[row, col]) * fill
+
+
+def push_pull(z, w):
+    # Fill the cells of weight below 1 from the pyramid of the others, in time linear in the number of cells
+    if z.shape[0] == 1 and z.shape[1] == 1:
+        return z
+    coarse_z, coarse_w = pull(z, w)
+    coarse_z = push_pull(coarse_z, coarse_w)
+    push(z, w, coarse_z)
+    return z
+
+
+def fill_holes(grid_z, x_min, y_max, gsd):
+    # Fill the cells without points (NaN) by push-pull, and leave those out of the convex hull of the others NaN
+    rows, cols = grid_z.shape
+    known = ~np.isnan(grid_z)
+    if not np.any(known):
+        return grid_z
+    grid_z[~known] = 0
+    grid_z = push_pull(grid_z, known.astype(np.float64))
+    occupied = np.argwhere(known)
+    if occupied.shape[0] >= 3 and np.linalg.matrix_rank(occupied - occupied[0]) == 2:
+        hull = occupied[ConvexHull(occupied).vertices]
+        polygon = np.vstack((x_min + hull[:, 1] * gsd, y_max - hull[:, 0] * gsd))
+        spans = footprint_spans(polygon, x_min, y_max, gsd, rows, cols)
+        inside = np.arange(cols) >= spans[:, 0:1]
+        inside &= np.arange(cols) < spans[:, 1:2]
+        grid_z[~inside] = np.nan
+    return grid_z
+
+
+def rasterize_dem(xyz, gsd, statistic="mean"):
+    # A DEM on the same grid as interpolate_dem, in time linear in the number of points instead of triangulating them
+    # 1. bin the points into the nearest grid node, and reduce the heights in each cell by `statistic`
+    # 2. fill the holes by push-pull, and leave the cells out of the convex hull of the points NaN like griddata
+    X_min = np.min(xyz[:, 0])
+    X_max = np.max(xyz[:, 0])
+    Y_min = np.min(xyz[:, 1])
+    Y_max = np.max(xyz[:, 1])
 
-def generate_dem(point_clouds, gsd):
-    start = time.time()
+    # The shape of np.mgrid[Y_max:Y_min:-gsd, X_min:X_max:gsd]
+    rows = int(np.ceil((Y_max - Y_min) / gsd))
+    cols = int(np.ceil((X_max - X_min) / gsd))
+
+    # 1. Binning
+    cells = bin_points(xyz, X_min, Y_max, gsd, rows, cols)
+    sorted_z, start = sort_by_cell(cells, np.ascontiguousarray(xyz[:, 2]), rows * cols)
+    grid_z = reduce_cells(sorted_z, start, statistic).reshape(rows, cols)
+
+    # 2. Hole filling
+    grid_z = fill_holes(grid_z, X_min, Y_max, gsd)
+
+    return DEM(grid_z, X_min, Y_max, gsd)
+
+
+@jit(nopython=True, cache=True)
+def accumulate(cells, rows, cols, z):
+    # Fold heights into the accumulators of their cells: count, sum, min and max
+    for i in range(z.size):
+        cells[0, rows[i], cols[i]] += 1
+        cells[1, rows[i], cols[i]] += z[i]
+        cells[2, rows[i], cols[i]] = min(cells[2, rows[i], cols[i]], z[i])
+        cells[3, rows[i], cols[i]] = max(cells[3, rows[i], cols[i]], z[i])
+
+
+class TiledDEM:
+    # A DEM that lives across frames, on a global grid of nodes at (col * gsd, -row * gsd)
+    # in tiles of tile_size x tile_size cells, created as points fall in them
+    # A cell keeps accumulators of the heights of its points, so a frame folds in only the points new to the DEM
+    # and its rasterization costs the new area instead of the whole cloud of the window
+    # The ground points it takes are classified apart, by ground_points (incremental with a LabelCache)
+    # The points of a window come again in the next windows, moved slightly by the bundle adjustment,
+    # so a point is new only if no point before fell in its voxel of voxel_size (gsd by default)
+    # With a path, the tiles are memory-mapped files in a store of an EPSG, which later runs over the same site
+    # read for the footprints already covered
+    def __init__(self, gsd=0, tile_size=256, voxel_size=0, path="", epsg=0):
+        self.gsd = gsd  # 0: the gsd of the first frame
+        self.tile_size = tile_size
+        self.voxel_size = voxel_size
+        self.path = path    # "" for the tiles in memory only
+        self.epsg = epsg
+        self.tiles = {}     # (tile_row, tile_col) -> accumulators of shape (4, tile_size, tile_size)
+        self.voxels = {}    # (tile_row, tile_col) -> sorted keys of the voxels folded in
+        self.touched = set()    # tiles folded points in by this run
+
+    def tile_file(self, key):
+        # The file of a tile in the store, by the EPSG, the grid and the tile index
+        return Path(self.path) / str(self.epsg) / f"{round(self.gsd * 1000)}mm_{self.tile_size}" / \
+            f"{key[0]}_{key[1]}.npy"
+
+    def load(self, key):
+        # A tile in memory, or mapped from the store, None if in neither
+        if key not in self.tiles and self.path:
+            file = self.tile_file(key)
+            if file.exists():
+                self.tiles[key] = np.load(file, mmap_mode="r+")
+                voxels = file.with_suffix(".voxels.npy")
+                self.voxels[key] = np.load(voxels) if voxels.exists() else np.empty(0, dtype=np.int64)
+        return self.tiles.get(key)
+
+    def tile(self, key):
+        # A tile, created empty if in neither memory nor the store
+        if self.load(key) is None:
+            shape = (4, self.tile_size, self.tile_size)
+            if self.path:
+                self.tile_file(key).parent.mkdir(parents=True, exist_ok=True)
+                cells = np.lib.format.open_memmap(self.tile_file(key), mode="w+", dtype=np.float64, shape=shape)
+                cells[:2] = 0
+            else:
+                cells = np.zeros(shape=shape)
+            cells[2] = np.inf
+            cells[3] = -np.inf
+            self.tiles[key] = cells
+            self.voxels[key] = np.empty(0, dtype=np.int64)
+        return self.tiles[key]
+
+    def flush(self, keys):
+        # Write tiles through to the store
+        for key in keys:
+            self.tiles[key].flush()
+            np.save(self.tile_file(key).with_suffix(".voxels.npy"), self.voxels[key])
+
+    def add(self, xyz):
+        # Fold the points new to the DEM in, and return the number of them
+        if xyz.shape[0] == 0:
+            return 0
+        voxel_size = self.voxel_size if self.voxel_size > 0 else self.gsd
+        rows = np.floor(-xyz[:, 1] / self.gsd + 0.5).astype(np.int64)
+        cols = np.floor(xyz[:, 0] / self.gsd + 0.5).astype(np.int64)
+        tile_rows = rows // self.tile_size
+        tile_cols = cols // self.tile_size
+        # Voxel of a point relative to the corner of its tile: 20 bits of a row and a column, the rest for a height
+        voxel_rows = np.floor(-xyz[:, 1] / voxel_size).astype(np.int64)
+        voxel_rows -= np.floor((tile_rows * self.tile_size - 0.5) * self.gsd / voxel_size).astype(np.int64)
+        voxel_cols = np.floor(xyz[:, 0] / voxel_size).astype(np.int64)
+        voxel_cols -= np.floor((tile_cols * self.tile_size - 0.5) * self.gsd / voxel_size).astype(np.int64)
+        voxel_heights = np.floor(xyz[:, 2] / voxel_size).astype(np.int64) + 2 ** 22
+        keys = (voxel_heights << 40) | (voxel_rows << 20) | voxel_cols
+
+        # Group the points by tile
+        order = np.argsort((tile_rows << 32) + tile_cols)
+        tile_rows = tile_rows[order]
+        tile_cols = tile_cols[order]
+        bounds = np.flatnonzero((np.diff(tile_rows) != 0) | (np.diff(tile_cols) != 0)) + 1
+        bounds = np.concatenate(([0], bounds, [order.size]))
+
+        no_new_points = 0
+        keys_touched = []
+        for k in range(bounds.size - 1):
+            key = (int(tile_rows[bounds[k]]), int(tile_cols[bounds[k]]))
+            cells = self.tile(key)
+            keys_touched.append(key)
+            self.touched.add(key)
+            points = order[bounds[k]:bounds[k + 1]]
+            new_keys, first = np.unique(keys[points], return_index=True)
+            new = ~np.isin(new_keys, self.voxels[key], assume_unique=True)
+            points = points[first[new]]
+            self.voxels[key] = np.union1d(self.voxels[key], new_keys[new])
+            accumulate(cells, rows[points] - key[0] * self.tile_size, cols[points] - key[1] * self.tile_size,
+                       xyz[points, 2])
+            no_new_points += points.size
+        if self.path:
+            self.flush(keys_touched)
+        return no_new_points
+
+    def patch(self, x_min, x_max, y_min, y_max, statistic="mean", fill=True, stored_only=False):
+        # The DEM over a bounding box, on the nodes of the global grid, with holes filled like rasterize_dem
+        # or left NaN, where no point fell, if not fill
+        # stored_only: of the tiles of the runs before only, not yet touched by this run
+        if statistic == "median":
+            raise ValueError("The median of a cell is not incremental, choose one of min, mean, max")
+        method = {"min": 2, "max": 3}.get(statistic, 1)
+        row_min = int(np.floor(-y_max / self.gsd))
+        row_max = int(np.ceil(-y_min / self.gsd))
+        col_min = int(np.floor(x_min / self.gsd))
+        col_max = int(np.ceil(x_max / self.gsd))
+        rows = row_max - row_min + 1
+        cols = col_max - col_min + 1
+
+        grid_z = np.full(shape=(rows, cols), fill_value=np.nan)
+        for tile_row in range(row_min // self.tile_size, row_max // self.tile_size + 1):
+            for tile_col in range(col_min // self.tile_size, col_max // self.tile_size + 1):
+                cells = self.load((tile_row, tile_col))
+                if cells is None or (stored_only and (tile_row, tile_col) in self.touched):
+                    continue
+                # Overlap of the tile and the patch, in global cells
+                r0 = max(tile_row * self.tile_size, row_min)
+                r1 = min((tile_row + 1) * self.tile_size, row_max + 1)
+                c0 = max(tile_col * self.tile_size, col_min)
+                c1 = min((tile_col + 1) * self.tile_size, col_max + 1)
+                tile_slice = np.s_[r0 - tile_row * self.tile_size:r1 - tile_row * self.tile_size,
+                                   c0 - tile_col * self.tile_size:c1 - tile_col * self.tile_size]
+                count = cells[0][tile_slice]
+                if method == 1:
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        z = cells[1][tile_slice] / count
+                else:
+                    z = cells[method][tile_slice]
+                grid_z[r0 - row_min:r1 - row_min, c0 - col_min:c1 - col_min] = np.where(count > 0, z, np.nan)
+
+        X_min = col_min * self.gsd
+        Y_max = -row_min * self.gsd
+        if fill:
+            grid_z = fill_holes(grid_z, X_min, Y_max, self.gsd)
+
+        return DEM(grid_z, X_min, Y_max, self.gsd)
+
+
+@jit(nopython=True, cache=True)
+def voxel_downsample(xyz, voxel_size, lowest=True, known=np.empty(0, dtype=np.bool_), tolerance=0.):
+    # Indices of one point of each voxel column of voxel_size x voxel_size m: the lowest, or the highest
+    # The columns are on a grid anchored at the origin, so the clouds of overlapping windows share them
+    # known: points to keep instead if within tolerance m of the height of the lowest (highest), e.g. labelled
+    keys = np.empty(xyz.shape[0], dtype=np.int64)
+    for i in range(xyz.shape[0]):
+        keys[i] = (np.int64(np.floor(xyz[i, 1] / voxel_size)) << 32) + np.int64(np.floor(xyz[i, 0] / voxel_size))
+    order = np.argsort(keys, kind="mergesort")
+    sign = 1. if lowest else -1.
+    kept = np.empty(xyz.shape[0], dtype=np.int64)
+    n = 0
+    start = 0
+    for k in range(1, order.size + 1):
+        if k < order.size and keys[order[k]] == keys[order[start]]:
+            continue
+        # A column of order[start:k]
+        best = -1
+        best_known = -1
+        for m in range(start, k):
+            i = order[m]
+            if best < 0 or sign * xyz[i, 2] < sign * xyz[best, 2]:
+                best = i
+            if known.size > 0 and known[i] and (best_known < 0 or sign * xyz[i, 2] < sign * xyz[best_known, 2]):
+                best_known = i
+        if best_known >= 0 and sign * (xyz[best_known, 2] - xyz[best, 2]) <= tolerance:
+            best = best_known
+        kept[n] = best
+        n += 1
+        start = k
+    return np.sort(kept[:n])
+
+
+def voxel_step(voxel_size, steps_per_octave=4):
+    # The size rounded up to a ladder of 2^(1/steps) m, so that windows of about the same extent take the same voxels
+    return 2 ** (np.ceil(steps_per_octave * np.log2(voxel_size)) / steps_per_octave)
+
+
+def downsample(xyz, voxel_size=0, point_budget=0, lowest=True, label_cache=None):
+    # Points downsampled by voxel columns of voxel_size m, enlarged until at most point_budget points remain
+    # voxel_size: 0 for the size of about point_budget voxels over the extent. point_budget: 0 for no limit
+    # The sizes for the budget are on the ladder of voxel_step, so they hold from frame to frame
+    # label_cache: a LabelCache whose points a column keeps over its lowest (highest) point moved in height
+    # by the bundle adjustment, so that the same points of the windows are kept and their labels reused
+    if xyz.shape[0] == 0 or (voxel_size <= 0 and (point_budget <= 0 or xyz.shape[0] <= point_budget)):
+        return xyz
+    if voxel_size <= 0:
+        width, height = np.ptp(xyz[:, :2], axis=0)
+        voxel_size = voxel_step(max(np.sqrt(width * height / point_budget), 1e-3))
+    known, tolerance = np.empty(0, dtype=np.bool_), 0.
+    if label_cache is not None:
+        known, tolerance = cached_labels(xyz, label_cache) >= 0, label_cache.tolerance
+    kept = voxel_downsample(xyz, voxel_size, lowest, known, tolerance)
+    while 0 < point_budget < kept.size:
+        # Voxels of the occupied area shrink in number by the square of the size
+        voxel_size = voxel_step(voxel_size * np.sqrt(kept.size / point_budget) * 1.01)
+        kept = voxel_downsample(xyz, voxel_size, lowest, known, tolerance)
+    return xyz[kept]
+
+
+def remove_outliers(xyz):
+    # Indices of the inliers by the statistical outlier removal
+    cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(xyz))
+    cl, ind = cloud.remove_statistical_outlier(nb_neighbors=6, std_ratio=1.0)
+    return np.asarray(ind, dtype=np.int64)
+
+
+# Labels of a point
+OUTLIER = 0
+GROUND = 1
+NON_GROUND = 2
+
+
+class LabelCache:
+    # Labels of the voxels of the points denoised and filtered in the frames before, as sorted keys of the voxels
+    # The windows export mostly the same tie points again, so only the points in new voxels need to be classified
+    # Voxels not seen for max_age frames, left behind the flight by the crop to the footprint, are evicted
+    def __init__(self, voxel_size=0.25, max_age=3, context=5., tolerance=0.):
+        self.voxel_size = voxel_size
+        self.max_age = max_age
+        self.context = context      # m around the new points, whose known inliers are classified along with them
+        self.tolerance = tolerance or voxel_size / 2    # m a point moves by and keeps the label of a known voxel
+        self.origin = None
+        self.keys = np.empty(0, dtype=np.int64)
+        self.labels = np.empty(0, dtype=np.int8)
+        self.seen = np.empty(0, dtype=np.int64)     # the last frame a voxel is in
+        self.frame = 0
+
+    def voxels(self, xyz):
+        # Keys of the voxels of points: 21 bits of each axis from the origin, within 2^20 voxels of it
+        if self.origin is None:
+            self.origin = np.floor(xyz.min(axis=0))
+        index = np.floor((xyz - self.origin) / self.voxel_size).astype(np.int64) + 2 ** 20
+        return (index[:, 0] << 42) | (index[:, 1] << 21) | index[:, 2]
+
+    def lookup(self, keys):
+        # Labels of voxels, -1 for those not in the cache
+        if self.keys.size == 0:
+            return np.full(keys.size, -1, dtype=np.int8)
+        position = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        found = self.keys[position] == keys
+        self.seen[position[found]] = self.frame
+        return np.where(found, self.labels[position], -1).astype(np.int8)
+
+    def update(self, keys, labels):
+        # Add the labels of new voxels, the first of a voxel for all its points, and evict the old ones
+        keys, first = np.unique(keys, return_index=True)
+        keep = self.frame - self.seen <= self.max_age
+        self.keys = np.concatenate((self.keys[keep], keys))
+        self.labels = np.concatenate((self.labels[keep], labels[first]))
+        self.seen = np.concatenate((self.seen[keep], np.full(keys.size, self.frame)))
+        order = np.argsort(self.keys)
+        self.keys = self.keys[order]
+        self.labels = self.labels[order]
+        self.seen = self.seen[order]
+        self.frame += 1
+
+
+def classify_points(xyz, csf_params=None):
+    # Labels of points by denoising and ground filtering
+    labels = np.full(xyz.shape[0], OUTLIER, dtype=np.int8)
+    inliers = remove_outliers(xyz)
+    labels[inliers] = NON_GROUND
+    _, ground = tiled_cloth_simulation_filtering(xyz[inliers], **(csf_params or {}))
+    labels[inliers[ground]] = GROUND
+    return labels
+
+
+def cached_labels(xyz, label_cache, keys=None):
+    # Labels of points in the cache, -1 for those new to it
+    labels = label_cache.lookup(label_cache.voxels(xyz) if keys is None else keys)
+    # A point moved out of its voxel by the bundle adjustment takes the label of the nearest known voxel
+    # of the 26 around, within tolerance of it
+    missing = np.flatnonzero(labels < 0)
+    distance = np.full(missing.size, np.inf)
+    size = label_cache.voxel_size
+    for offset in np.array(np.meshgrid(*[(-size, 0, size)] * 3)).reshape(3, -1).T:
+        if missing.size == 0 or not np.any(offset):
+            continue
+        moved = xyz[missing] + offset
+        found = label_cache.lookup(label_cache.voxels(moved))
+        # From a point to the box of the voxel next to it
+        center = (np.floor((moved - label_cache.origin) / size) + 0.5) * size + label_cache.origin - offset
+        gap = np.linalg.norm(np.maximum(np.abs(xyz[missing] - center) - size / 2, 0), axis=1)
+        nearer = (found >= 0) & (gap <= label_cache.tolerance) & (gap < distance)
+        labels[missing[nearer]] = found[nearer]
+        distance[nearer] = gap[nearer]
+    return labels
+
+
+def classify_new_points(xyz, label_cache, csf_params=None):
+    # Labels of points from the cache, and by classifying those in new voxels along with the known inliers around
+    keys = label_cache.voxels(xyz)
+    labels = cached_labels(xyz, label_cache, keys)
+    new = labels < 0
+    print("No. new points:", np.count_nonzero(new))
+    if np.any(new):
+        # The known inliers in the cells of context m of the new points, and in the cells next to those
+        # of a new area, mostly of new points, so that the isolated new points left over the window
+        # by the bundle adjustment and the downsampling take in only their own cells
+        cells = np.floor((xyz[:, :2] - xyz[:, :2].min(axis=0)) / label_cache.context).astype(np.int64) + 1
+        cell_keys = (cells[:, 0] << 32) | cells[:, 1]
+        unique_keys, inverse = np.unique(cell_keys, return_inverse=True)
+        new_ratio = np.bincount(inverse, weights=new) / np.bincount(inverse)
+        open_cells = cells[new & (new_ratio[inverse] >= 0.25)]
+        near = np.unique(np.concatenate([cell_keys[new]] + [((open_cells[:, 0] + i) << 32) | (open_cells[:, 1] + j)
+                                                             for i in (-1, 0, 1) for j in (-1, 0, 1)]))
+        around = ~new & (labels != OUTLIER) & np.isin(cell_keys, near)
+        subset = np.flatnonzero(new | around)
+        labels[subset] = np.where(new[subset], classify_points(xyz[subset], csf_params), labels[subset])
+    label_cache.update(keys[new], labels[new])
+    return labels
+
+
+def relief(xyz, cell_size=2., object_height=2.):
+    # Relief of a cloud
+    # height: median of the heights, spread: robust deviation from it, by the 2nd and 98th percentiles - unit: m
+    # objects: ratio of the cells rising more than object_height m above the slope of the lowest surface
+    # of cells of cell_size m (its median where unknown), e.g. of buildings or trees
+    low, height, high = np.percentile(xyz[:, 2], [2, 50, 98])
+    spread = max(high - height, height - low)
+
+    x_min = xyz[:, 0].min()
+    y_max = xyz[:, 1].max()
+    rows = int((y_max - xyz[:, 1].min()) / cell_size) + 2
+    cols = int((xyz[:, 0].max() - x_min) / cell_size) + 2
+    cells = bin_points(xyz, x_min, y_max, cell_size, rows, cols)
+    sorted_z, start = sort_by_cell(cells, np.ascontiguousarray(xyz[:, 2]), rows * cols)
+    lowest = reduce_cells(sorted_z, start, "min").reshape(rows, cols)
+    highest = reduce_cells(sorted_z, start, "max").reshape(rows, cols)
+
+    gradient_y, gradient_x = np.gradient(lowest, cell_size)
+    slopes = np.hypot(gradient_x, gradient_y)   # NaN next to the empty cells
+    slope = np.nanmedian(slopes) if np.any(~np.isnan(slopes)) else 0.
+    rise = highest - lowest - np.nan_to_num(slopes, nan=slope) * cell_size
+    occupied = ~np.isnan(lowest)
+    objects = np.count_nonzero(rise[occupied] > object_height) / max(np.count_nonzero(occupied), 1)
+
+    return height, spread, objects
+
+
+def read_points(point_clouds, region=None):
+    # region: [X min, X max, Y min, Y max] to crop the points to, None for all of them
     # 1. Import point clouds
     # inFile = laspy.file.File(point_clouds, mode='r')  # read a las file
     # points = inFile.points
@@ -101,17 +713,47 @@ def generate_dem(point_clouds, gsd):
     # print("No. raw points:", len(xyz))
 
     cloud = o3d.io.read_point_cloud(point_clouds)
-    print("No. raw points:", len(cloud.points))
+    xyz = np.asarray(cloud.points)
+    print("No. raw points:", len(xyz))
+    if region is not None:
+        inside = (xyz[:, 0] >= region[0]) & (xyz[:, 0] <= region[1]) & \
+                 (xyz[:, 1] >= region[2]) & (xyz[:, 1] <= region[3])
+        xyz = xyz[inside]
+        print("No. cropped points:", len(xyz))
+
+    return xyz
+
+
+def ground_points(xyz, csf_params=None, label_cache=None, surface="dtm", voxel_size=0, point_budget=0):
+    # The points of a surface from a cloud
+    # csf_params: keyword arguments of tiled_cloth_simulation_filtering
+    # label_cache: a LabelCache to classify only the points new to it, None for all of them
+    # surface: dtm for the ground points, dsm for all the inliers
+    # voxel_size, point_budget: of downsample, by the lowest point of a voxel for a DTM, the highest for a DSM
+    xyz = downsample(xyz, voxel_size, point_budget, surface != "dsm", label_cache if surface != "dsm" else None)
+    print("No. downsampled points:", len(xyz))
+
+    if surface == "dsm":
+        # 2. Denoising, without ground filtering
+        xyz = xyz[remove_outliers(xyz)]
+        print("No. denoised points:", len(xyz))
+        return xyz
+
+    if label_cache is not None:
+        # 2. & 3. Denoising and ground filtering of the new points
+        csf_start = time.time()
+        filtered_xyz = xyz[classify_new_points(xyz, label_cache, csf_params) == GROUND]
+        print("No. filtered points:", len(filtered_xyz))
+        print(f"Ground filetering: {time.time() - csf_start:.2f} sec")
+        return filtered_xyz
 
     # 2. Denoising
-    cl, ind = cloud.remove_statistical_outlier(nb_neighbors=6, std_ratio=1.0)
-    inlier_cloud = cloud.select_by_index(ind)
-    xyz = np.asarray(inlier_cloud.points)
+    xyz = xyz[remove_outliers(xyz)]
     print("No. denoised points:", len(xyz))
 
     # 3. Ground filtering
     csf_start = time.time()
-    filtered_xyz, ground = cloth_simulation_filtering(xyz)
+    filtered_xyz, ground = tiled_cloth_simulation_filtering(xyz, **(csf_params or {}))
     print("No. filtered points:", len(filtered_xyz))
     print(f"Ground filetering: {time.time() - csf_start:.2f} sec")
 
@@ -120,17 +762,29 @@ def generate_dem(point_clouds, gsd):
     # outFile.close()  # do not forget this
     # filtered_xyz = xyz
 
+    return filtered_xyz
+
+
+def generate_dem(xyz, gsd, interpolation="raster", statistic="mean", csf_params=None, label_cache=None,
+                 surface="dtm", voxel_size=0, point_budget=0):
+    # xyz: points from read_points, whose grid covers them, so lies within the region they are cropped to
+    start = time.time()
+    filtered_xyz = ground_points(xyz, csf_params, label_cache, surface, voxel_size, point_budget)
+
     # 4. Interpolation
     interpolation_start = time.time()
-    grid_x, grid_y, grid_z, bbox = interpolate_dem(filtered_xyz, gsd)
+    if interpolation == "griddata":
+        dem = interpolate_dem(filtered_xyz, gsd)
+    else:
+        dem = rasterize_dem(filtered_xyz, gsd, statistic)
     print(f"Interpolation: {time.time() - interpolation_start:.2f} sec")
     print(f"Elpased time: {time.time() - start:.2f} sec")
 
     # import matplotlib.pyplot as plt
-    # plt.imshow(grid_z)
+    # plt.imshow(dem.z)
     # plt.show()
 
-    return grid_x, grid_y, grid_z, bbox
+    return dem
 
 if __name__ == "__main__":
-    generate_dem("pointclouds.las", 0.03)
+    generate_dem(read_points("pointclouds.las"), 0.03)
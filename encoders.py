@@ -0,0 +1,181 @@
+import struct
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import cv2
+from numba import jit
+
+from rectification import create_world_file, create_optical, create_geotiff_optical
+
+WEBP_MAX_SIDE = 16383
+
+
+@jit(nopython=True, cache=True)
+def qoi_chunks(image, out, start):
+    # The chunks of the QOI format of an 8-bit BGR(A) image, written into out from start, returning their end
+    # https://qoiformat.org/qoi-specification.pdf
+    rows, cols, channels = image.shape
+    index = np.zeros((64, 4), dtype=np.int64)
+    pr, pg, pb, pa = 0, 0, 0, 255
+    run = 0
+    n = start
+    for row in range(rows):
+        for col in range(cols):
+            b = np.int64(image[row, col, 0])
+            g = np.int64(image[row, col, 1])
+            r = np.int64(image[row, col, 2])
+            a = np.int64(image[row, col, 3]) if channels == 4 else 255
+            if r == pr and g == pg and b == pb and a == pa:
+                run += 1
+                if run == 62 or (row == rows - 1 and col == cols - 1):
+                    out[n] = 0xc0 | (run - 1)   # QOI_OP_RUN
+                    n += 1
+                    run = 0
+                continue
+            if run > 0:
+                out[n] = 0xc0 | (run - 1)
+                n += 1
+                run = 0
+
+            h = (r * 3 + g * 5 + b * 7 + a * 11) & 63
+            if index[h, 0] == r and index[h, 1] == g and index[h, 2] == b and index[h, 3] == a:
+                out[n] = h  # QOI_OP_INDEX
+                n += 1
+            else:
+                index[h, 0] = r
+                index[h, 1] = g
+                index[h, 2] = b
+                index[h, 3] = a
+                if a == pa:
+                    # Differences to the previous pixel, wrapped around
+                    vr = ((r - pr + 128) & 255) - 128
+                    vg = ((g - pg + 128) & 255) - 128
+                    vb = ((b - pb + 128) & 255) - 128
+                    vg_r = vr - vg
+                    vg_b = vb - vg
+                    if -3 < vr < 2 and -3 < vg < 2 and -3 < vb < 2:
+                        out[n] = 0x40 | ((vr + 2) << 4) | ((vg + 2) << 2) | (vb + 2)     # QOI_OP_DIFF
+                        n += 1
+                    elif -33 < vg < 32 and -9 < vg_r < 8 and -9 < vg_b < 8:
+                        out[n] = 0x80 | (vg + 32)                                       # QOI_OP_LUMA
+                        out[n + 1] = ((vg_r + 8) << 4) | (vg_b + 8)
+                        n += 2
+                    else:
+                        out[n] = 0xfe                                                   # QOI_OP_RGB
+                        out[n + 1] = r
+                        out[n + 2] = g
+                        out[n + 3] = b
+                        n += 4
+                else:
+                    out[n] = 0xff                                                       # QOI_OP_RGBA
+                    out[n + 1] = r
+                    out[n + 2] = g
+                    out[n + 3] = b
+                    out[n + 4] = a
+                    n += 5
+            pr, pg, pb, pa = r, g, b, a
+
+    return n
+
+
+def write_qoi(image, path):
+    # image: 8-bit BGR or BGRA
+    rows, cols, channels = image.shape
+    out = np.empty(14 + rows * cols * (channels + 1) + 8, dtype=np.uint8)
+    out[:14] = np.frombuffer(b"qoif" + struct.pack(">IIBB", cols, rows, channels, 0), dtype=np.uint8)
+    n = qoi_chunks(np.ascontiguousarray(image), out, 14)
+    out[n:n + 8] = [0, 0, 0, 0, 0, 0, 0, 1]     # the end marker
+    with open(path, "wb") as f:
+        f.write(out[:n + 8].tobytes())
+
+
+def encode_png(orthophoto, boundary, gsd, epsg, dst, level=None, workers=0):
+    # PNG of a level from 0 to 9 (3 by default), TIFF for the orthophotos PNG can't hold
+    create_optical(orthophoto, boundary, gsd, epsg, dst, 3 if level is None else level)
+
+
+def encode_webp(orthophoto, boundary, gsd, epsg, dst, level=None, workers=0):
+    # Lossless WebP of 8-bit BGRA up to 16383 px a side, PNG otherwise
+    if orthophoto.dtype != np.uint8 or orthophoto.shape[2] != 4 or max(orthophoto.shape[:2]) > WEBP_MAX_SIDE:
+        return encode_png(orthophoto, boundary, gsd, epsg, dst)
+    cv2.imwrite(dst + '.webp', orthophoto, [int(cv2.IMWRITE_WEBP_QUALITY), 101])  # above 100: lossless
+    create_world_file(boundary, gsd, dst + '.wpw')
+
+
+def encode_qoi(orthophoto, boundary, gsd, epsg, dst, level=None, workers=0):
+    # QOI, a fast lossless format of a single pass, of 8-bit BGRA, PNG otherwise
+    if orthophoto.dtype != np.uint8 or orthophoto.shape[2] != 4:
+        return encode_png(orthophoto, boundary, gsd, epsg, dst)
+    write_qoi(orthophoto, dst + '.qoi')
+    create_world_file(boundary, gsd, dst + '.qiw')
+
+
+def geotiff_encoder(compression):
+    def encode(orthophoto, boundary, gsd, epsg, dst, level=None, workers=0):
+        create_geotiff_optical(orthophoto, boundary, gsd, epsg, dst, compression, level or 0, workers)
+    return encode
+
+
+# Encoders of the orthophotos by name, called with (orthophoto, boundary, gsd, epsg, dst, level, workers)
+ENCODERS = {
+    "png": encode_png,
+    "webp": encode_webp,
+    "qoi": encode_qoi,
+    "deflate": geotiff_encoder("deflate"),      # tiled GeoTIFFs
+    "zstd": geotiff_encoder("zstd"),
+    "jpeg": geotiff_encoder("jpeg"),            # with the alpha as a mask
+    "none": geotiff_encoder("none"),
+}
+
+
+def parse_encoder(encoder):
+    # "name" or "name:level", e.g. "png:1" or "jpeg:85"
+    name, _, level = encoder.partition(":")
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown encoder: {encoder}")
+    return name, int(level) if level else None
+
+
+def encode_optical(orthophoto, boundary, gsd, epsg, dst, encoder="png", workers=0):
+    name, level = parse_encoder(encoder)
+    ENCODERS[name](orthophoto, boundary, gsd, epsg, dst, level, workers)
+
+
+def measure_encoder(orthophoto, encoder, workers=0, repeat=1):
+    # The median time to encode an orthophoto and the bytes of its files, written in a temporary directory
+    elapsed = np.empty(repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        dst = str(Path(directory) / "orthophoto")
+        boundary = np.array([0., orthophoto.shape[1], 0., orthophoto.shape[0]])
+        # A corner first, for the JIT compilation and the setup of the encoder
+        encode_optical(np.ascontiguousarray(orthophoto[:16, :16]), boundary, 1., 0, dst, encoder, workers)
+        for i in range(repeat):
+            start = time.time()
+            encode_optical(orthophoto, boundary, 1., 0, dst, encoder, workers)
+            elapsed[i] = time.time() - start
+        size = sum(file.stat().st_size for file in Path(directory).iterdir())
+
+    return np.median(elapsed), size
+
+
+def select_encoder(orthophoto, candidates, seconds=1., ratio=0, workers=0):
+    # The encoder of a run, measured on its first orthophoto:
+    # the fastest within ratio of the raw size if ratio > 0, else the smallest within seconds,
+    # the fastest of all if none meets the target
+    results = []
+    for encoder in candidates:
+        try:
+            results.append((encoder,) + measure_encoder(orthophoto, encoder, workers))
+        except Exception:   # e.g. zstd without zstandard, or an encoder that can't hold the orthophoto
+            continue
+    if not results:
+        raise ValueError(f"No encoder of {candidates}")
+    raw = orthophoto.nbytes
+    if ratio > 0:
+        within = sorted([result for result in results if result[2] <= ratio * raw], key=lambda result: result[1])
+    else:
+        within = sorted([result for result in results if result[1] <= seconds], key=lambda result: result[2])
+    fastest = min(results, key=lambda result: result[1])
+
+    return (within[0] if within else fastest)[0], results
@@ -178,6 +178,35 @@ def rpy_to_opk(rpy, maker=""):
         return np.array([float(omega_phi[0, 0]), float(omega_phi[1, 0]), kappa])
 
 
+def get_calibration(sensor):
+    # Interior orientation adjusted by Metashape, in the frame camera model
+    # f, cx, cy, b1, b2 - unit: px, cx and cy from the center of the image
+    calibration = sensor.calibration
+    return np.array([calibration.f, calibration.cx, calibration.cy, calibration.b1, calibration.b2,
+                     calibration.k1, calibration.k2, calibration.k3, calibration.k4, calibration.p1, calibration.p2])
+
+
+# EO records of the sidecars read ahead, e.g. by processing.Prefetcher, by the path of the image
+eo_sidecars = {}
+
+
+def eo_sidecar(image):
+    # The .csv next to an image
+    return str(Path(image).parent / Path(image).stem) + ".csv"
+
+
+def read_eo_sidecar(image):
+    # longitude, latitude, altitude, roll, pitch, yaw of an image in its sidecar, as they are written
+    if image in eo_sidecars:
+        return eo_sidecars.pop(image)
+    with open(eo_sidecar(image), "r") as f:
+        next(f)
+        eo = f.readline()
+    _, longitude, latitude, altitude, roll, pitch, yaw = eo.split(",")
+
+    return longitude, latitude, altitude, roll, pitch, yaw
+
+
 # https://www.agisoft.com/forum/index.php?topic=4669.0
 def set_region(chunk):
     point_cloud = chunk.point_cloud
@@ -228,11 +257,7 @@ def solve_direct_georeferencing(image, metadata_in_image, sys_cal, epsg=5186):
         gimbal_yaw = float(camera.photo.meta["DJI/GimbalYawDegree"])
         ori = rpy_to_opk(np.array([gimbal_roll, gimbal_pitch, gimbal_yaw]))
     else:
-        eo_file = str(Path(image).parent / Path(image).stem) + ".csv"
-        with open(eo_file, "r") as f:
-            next(f)
-            eo = f.readline()
-        _, longitude, latitude, altitude, roll, pitch, yaw = eo.split(",")
+        longitude, latitude, altitude, roll, pitch, yaw = read_eo_sidecar(image)
         camera.reference.location = (float(longitude), float(latitude), float(altitude))
         ori = rpy_to_opk(np.array([roll, pitch, yaw], dtype=np.float), maker=sys_cal)
 
@@ -248,13 +273,14 @@ def solve_direct_georeferencing(image, metadata_in_image, sys_cal, epsg=5186):
 
     focal_length = chunk.sensors[0].focal_length / 1000  # unit: m
     pixel_size = chunk.sensors[0].pixel_width / 1000  # unit: m
+    calibration = get_calibration(chunk.sensors[0])
 
     process_end = time.time() - start_time
     print("*************************************************************")
     print("  *** process time of each image = ", process_end)
     print("*************************************************************")
 
-    return eo, focal_length, pixel_size, 0
+    return eo, focal_length, pixel_size, 0, calibration
 
 
 def solve_lba_first(images, metadata_in_image, sys_cal, epsg=5186, downscale=2, diff_init_esti=10, output_path="."):
@@ -298,11 +324,7 @@ def solve_lba_first(images, metadata_in_image, sys_cal, epsg=5186, downscale=2,
     else:
         for camera in chunk.cameras:
             image = camera.photo.path
-            eo_file = str(Path(image).parent / Path(image).stem) + ".csv"
-            with open(eo_file, "r") as f:
-                next(f)
-                eo = f.readline()
-            _, longitude, latitude, altitude, roll, pitch, yaw = eo.split(",")
+            longitude, latitude, altitude, roll, pitch, yaw = read_eo_sidecar(image)
             camera.reference.location = (float(longitude), float(latitude), float(altitude))
             ori = rpy_to_opk(np.array([roll, pitch, yaw], dtype=np.float), maker=sys_cal)
             camera.reference.rotation = ori
@@ -353,6 +375,7 @@ def solve_lba_first(images, metadata_in_image, sys_cal, epsg=5186, downscale=2,
 
     focal_length = chunk.sensors[0].focal_length / 1000  # unit: m
     pixel_size = chunk.sensors[0].pixel_width / 1000  # unit: m
+    calibration = get_calibration(chunk.sensors[0])
 
     # Set region for the last image
     set_region(chunk)
@@ -376,7 +399,7 @@ def solve_lba_first(images, metadata_in_image, sys_cal, epsg=5186, downscale=2,
     print("  *** process time of each image = ", process_end)
     print("*************************************************************")
 
-    return eo, focal_length, pixel_size, center_z
+    return eo, focal_length, pixel_size, center_z, calibration
 
 
 def solve_lba_init_uni(images, epsg=5186, downscale=2):
@@ -446,6 +469,7 @@ def solve_lba_init_uni(images, epsg=5186, downscale=2):
 
     focal_length = chunk.sensors[0].focal_length / 1000  # unit: m
     pixel_size = chunk.sensors[0].pixel_width / 1000  # unit: m
+    calibration = get_calibration(chunk.sensors[0])
     # Set region for the last image
     set_region(chunk)
     # https://www.agisoft.com/forum/index.php?topic=3848.0
@@ -468,7 +492,7 @@ def solve_lba_init_uni(images, epsg=5186, downscale=2):
     print("  *** process time of each image = ", process_end)
     print("*************************************************************")
 
-    return eo, focal_length, pixel_size, center_z
+    return eo, focal_length, pixel_size, center_z, calibration
 
 
 def solve_lba_esti_div(images, epsg=5186, downscale=2):
@@ -560,6 +584,7 @@ def solve_lba_esti_div(images, epsg=5186, downscale=2):
 
     focal_length = chunk.sensors[0].focal_length / 1000  # unit: m
     pixel_size = chunk.sensors[0].pixel_width / 1000  # unit: m
+    calibration = get_calibration(chunk.sensors[0])
     # Set region for the last image
     set_region(chunk)
     # https://www.agisoft.com/forum/index.php?topic=3848.0
@@ -586,7 +611,7 @@ def solve_lba_esti_div(images, epsg=5186, downscale=2):
     print("  *** process time of each image = ", process_end)
     print("*************************************************************")
 
-    return eo, focal_length, pixel_size, center_z
+    return eo, focal_length, pixel_size, center_z, calibration
 
 
 def solve_lba_esti_uni(images, metadata_in_image, sys_cal, epsg=5186, downscale=2, diff_init_esti=10, output_path="."):
@@ -633,11 +658,7 @@ def solve_lba_esti_uni(images, metadata_in_image, sys_cal, epsg=5186, downscale=
         camera.reference.rotation = ori
         camera.reference.rotation_enabled = True
     else:
-        eo_file = str(Path(images[-1]).parent / Path(images[-1]).stem) + ".csv"
-        with open(eo_file, "r") as f:
-            next(f)
-            eo = f.readline()
-        _, longitude, latitude, altitude, roll, pitch, yaw = eo.split(",")
+        longitude, latitude, altitude, roll, pitch, yaw = read_eo_sidecar(images[-1])
         camera.reference.location = (float(longitude), float(latitude), float(altitude))
         camera.reference.location = Metashape.CoordinateSystem.transform(point=camera.reference.location,
                                                                          source=source_crs, target=target_crs)
@@ -694,6 +715,7 @@ def solve_lba_esti_uni(images, metadata_in_image, sys_cal, epsg=5186, downscale=
 
     focal_length = chunk.sensors[0].focal_length / 1000  # unit: m
     pixel_size = chunk.sensors[0].pixel_width / 1000  # unit: m
+    calibration = get_calibration(chunk.sensors[0])
     # Set region for the last image
     set_region(chunk)
     # https://www.agisoft.com/forum/index.php?topic=3848.0
@@ -723,7 +745,7 @@ def solve_lba_esti_uni(images, metadata_in_image, sys_cal, epsg=5186, downscale=
     print("  *** process time of each image = ", process_end)
     print("*************************************************************")
 
-    return eo, focal_length, pixel_size, center_z
+    return eo, focal_length, pixel_size, center_z, calibration
 
 
 if __name__ == '__main__':
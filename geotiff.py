@@ -0,0 +1,343 @@
+import os
+import struct
+import zlib
+import numpy as np
+import cv2
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # ZSTD tiles only
+    zstandard = None
+
+# https://www.awaresystems.be/imaging/tiff/tifftags/baseline.html
+# https://www.awaresystems.be/imaging/tiff/bigtiff.html
+SHORT = 3
+LONG = 4
+DOUBLE = 12
+LONG8 = 16
+TYPE_FORMATS = {SHORT: "H", LONG: "I", DOUBLE: "d", LONG8: "Q"}
+
+COMPRESSION_NONE = 1
+COMPRESSION_JPEG = 7
+COMPRESSION_DEFLATE = 8
+COMPRESSION_ZSTD = 50000
+COMPRESSIONS = {"none": COMPRESSION_NONE, "jpeg": COMPRESSION_JPEG, "deflate": COMPRESSION_DEFLATE,
+                "zstd": COMPRESSION_ZSTD}
+DEFAULT_LEVELS = {COMPRESSION_NONE: 0, COMPRESSION_JPEG: 90, COMPRESSION_DEFLATE: 3, COMPRESSION_ZSTD: 3}
+
+
+def sample_format(dtype):
+    # SampleFormat: 1 = unsigned integer, 2 = signed integer, 3 = floating point
+    return {"u": 1, "i": 2, "f": 3}[np.dtype(dtype).kind]
+
+
+def horizontal_predictor(block):
+    # Predictor 2: difference of each sample with the same sample of the previous pixel in a row
+    diff = block.copy()
+    diff[:, 1:] -= block[:, :-1]
+    return diff
+
+
+def geo_tags(boundary, gsd, epsg):
+    # GeoTIFF tags of a north-up grid whose pixel centers start at (boundary[0], boundary[3]), of an EPSG code
+    # http://docs.opengeospatial.org/is/19-008r4/19-008r4.html
+    tags = [
+        (33550, DOUBLE, [gsd, gsd, 0.]),                                # ModelPixelScale
+        (33922, DOUBLE, [0., 0., 0., boundary[0] - gsd / 2, boundary[3] + gsd / 2, 0.]),  # ModelTiepoint
+    ]
+    if epsg > 0:
+        geographic = 4000 <= epsg < 5000
+        keys = [
+            (1024, 0, 1, 2 if geographic else 1),                       # GTModelType: geographic, projected
+            (1025, 0, 1, 1),                                            # GTRasterType: PixelIsArea
+            (2048 if geographic else 3072, 0, 1, epsg),                 # GeographicType, ProjectedCSType
+        ]
+        directory = [1, 1, 0, len(keys)] + [value for key in keys for value in key]
+        tags.append((34735, SHORT, directory))                          # GeoKeyDirectory
+
+    return tags
+
+
+class TiffStripWriter:
+    # A TIFF written strip by strip, so that a large orthophoto never has to be in memory at once
+    # BigTIFF is used when the uncompressed image may not fit in 4 GB
+    def __init__(self, path, rows, cols, samples=4, dtype=np.uint8, rows_per_strip=256, compression="deflate",
+                 level=6, bgr=True, boundary=None, gsd=0, epsg=0):
+        self.rows = rows
+        self.cols = cols
+        self.samples = samples
+        self.dtype = np.dtype(dtype)
+        self.rows_per_strip = rows_per_strip
+        self.compression = COMPRESSION_DEFLATE if compression == "deflate" else COMPRESSION_NONE
+        self.level = level
+        self.predictor = self.compression == COMPRESSION_DEFLATE and self.dtype.kind in "ui"
+        self.bgr = bgr and samples in (3, 4)   # swap BGR(A) of OpenCV into RGB(A)
+        self.bigtiff = rows * cols * samples * self.dtype.itemsize > 2 ** 32 - 2 ** 20
+        self.geo_tags = geo_tags(boundary, gsd, epsg) if gsd > 0 else []
+
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.pending = np.empty(shape=(0, cols, samples), dtype=self.dtype)   # rows not filling a strip yet
+        self.rows_written = 0
+
+        self.f = open(path, "wb")
+        if self.bigtiff:
+            self.f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))    # IFD offset at byte 8
+        else:
+            self.f.write(b"II" + struct.pack("<HI", 42, 0))            # IFD offset at byte 4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, block):
+        # block: rows of shape (n, cols, samples), in order from the top
+        block = block.reshape(block.shape[0], self.cols, self.samples)
+        if self.pending.shape[0] > 0:
+            block = np.concatenate((self.pending, block), axis=0)
+        no_strips = block.shape[0] // self.rows_per_strip
+        for i in range(no_strips):
+            self.write_strip(block[i * self.rows_per_strip:(i + 1) * self.rows_per_strip])
+        self.pending = block[no_strips * self.rows_per_strip:].copy()
+
+    def write_strip(self, strip):
+        if self.bgr:
+            strip = strip[:, :, [2, 1, 0, 3][:self.samples]]
+        if self.predictor:
+            strip = horizontal_predictor(strip)
+        if self.compression == COMPRESSION_DEFLATE:
+            data = zlib.compress(np.ascontiguousarray(strip).tobytes(), self.level)
+        else:
+            data = np.ascontiguousarray(strip).tobytes()
+        self.strip_offsets.append(self.f.tell())
+        self.strip_byte_counts.append(len(data))
+        self.f.write(data)
+        self.rows_written += strip.shape[0]
+
+    def tags(self):
+        offset_type = LONG8 if self.bigtiff else LONG
+        tags = [
+            (256, LONG, [self.cols]),                                   # ImageWidth
+            (257, LONG, [self.rows]),                                   # ImageLength
+            (258, SHORT, [self.dtype.itemsize * 8] * self.samples),     # BitsPerSample
+            (259, SHORT, [self.compression]),                           # Compression
+            (262, SHORT, [2 if self.bgr else 1]),                       # PhotometricInterpretation: RGB, BlackIsZero
+            (273, offset_type, self.strip_offsets),                     # StripOffsets
+            (277, SHORT, [self.samples]),                               # SamplesPerPixel
+            (278, LONG, [self.rows_per_strip]),                         # RowsPerStrip
+            (279, offset_type, self.strip_byte_counts),                 # StripByteCounts
+            (284, SHORT, [1]),                                          # PlanarConfiguration: chunky
+        ]
+        if self.predictor:
+            tags.append((317, SHORT, [2]))                              # Predictor: horizontal differencing
+        no_extra_samples = self.samples - (3 if self.bgr else 1)
+        if no_extra_samples > 0:
+            # ExtraSamples: the last one is the unassociated alpha
+            tags.append((338, SHORT, [0] * (no_extra_samples - 1) + [2]))
+        tags.append((339, SHORT, [sample_format(self.dtype)] * self.samples))  # SampleFormat
+
+        return tags + self.geo_tags
+
+    def close(self):
+        if self.f.closed:
+            return
+        if self.pending.shape[0] > 0:
+            self.write_strip(self.pending)
+        # Rows never written, e.g. by an interrupted stream, stay empty
+        while self.rows_written < self.rows:
+            rows = min(self.rows_per_strip, self.rows - self.rows_written)
+            self.write_strip(np.zeros(shape=(rows, self.cols, self.samples), dtype=self.dtype))
+
+        ifd_offset = write_ifd(self.f, self.tags(), self.bigtiff)
+        self.f.seek(8 if self.bigtiff else 4)
+        self.f.write(struct.pack("<Q" if self.bigtiff else "<I", ifd_offset))
+        self.f.close()
+
+
+def write_ifd(f, tags, bigtiff, next_ifd=0):
+    # Write an Image File Directory at the end of a file
+    f.seek(0, 2)
+    if f.tell() % 2:
+        f.write(b"\0")  # IFDs begin on a word boundary
+    ifd_offset = f.tell()
+    f.write(pack_ifd(tags, bigtiff, ifd_offset, next_ifd))
+
+    return ifd_offset
+
+
+def pack_ifd(tags, bigtiff, ifd_offset, next_ifd=0):
+    # An Image File Directory at ifd_offset, with the values not fitting in an entry after it
+    # Its size depends on the tags and the number of their values only
+    count_format, entry_format, offset_format = ("<Q", "<HHQ", "<Q") if bigtiff else ("<H", "<HHI", "<I")
+    entry_size = 20 if bigtiff else 12
+    value_size = 8 if bigtiff else 4
+    tags = sorted(tags, key=lambda tag: tag[0])
+
+    data_offset = ifd_offset + struct.calcsize(count_format) + entry_size * len(tags) + value_size
+    entries = b""
+    data = b""
+    for tag, tag_type, values in tags:
+        packed = struct.pack("<" + TYPE_FORMATS[tag_type] * len(values), *values)
+        entries += struct.pack(entry_format, tag, tag_type, len(values))
+        if len(packed) <= value_size:
+            entries += packed.ljust(value_size, b"\0")
+        else:
+            entries += struct.pack(offset_format, data_offset + len(data))
+            data += packed
+            if len(data) % 2:
+                data += b"\0"
+
+    return struct.pack(count_format, len(tags)) + entries + struct.pack(offset_format, next_ifd) + data
+
+
+def encode_tile(tile, compression, level, predictor):
+    if predictor:
+        tile = horizontal_predictor(tile)
+    if compression == COMPRESSION_JPEG:
+        return cv2.imencode(".jpg", tile, [int(cv2.IMWRITE_JPEG_QUALITY), level])[1].tobytes()  # from BGR
+    data = np.ascontiguousarray(tile).tobytes()
+    if compression == COMPRESSION_DEFLATE:
+        return zlib.compress(data, level)
+    if compression == COMPRESSION_ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return data
+
+
+def half(image):
+    # The image at half its size, by area, in groups of up to 4 channels as OpenCV resizes no more at odd sizes
+    rows, cols, samples = image.shape
+    size = ((cols + 1) // 2, (rows + 1) // 2)
+    groups = [cv2.resize(np.ascontiguousarray(image[:, :, band:band + 4]), size, interpolation=cv2.INTER_AREA)
+              for band in range(0, samples, 4)]
+    return np.concatenate([group.reshape(size[1], size[0], -1) for group in groups], axis=2)
+
+
+def pyramid(image, tile_size):
+    # The image and its overviews, each half the size of the last, down to a single tile
+    levels = [image]
+    while max(levels[-1].shape[:2]) > tile_size:
+        levels.append(half(levels[-1]))
+
+    return levels
+
+
+def write_geotiff(path, image, boundary=None, gsd=0, epsg=0, tile_size=256, compression="deflate", level=0,
+                  overviews=True, workers=0, bgr=True):
+    # A tiled GeoTIFF of an image of shape (rows, cols, samples) in memory, with its overviews,
+    # laid out as a Cloud Optimized GeoTIFF: the IFDs first, then the tiles from the smallest overview
+    # The tiles are compressed in threads (zlib, zstandard and OpenCV release the GIL), a row of tiles at a time
+    # JPEG is for 8-bit BGR(A) only: the color in YCbCr, and the alpha as an internal 1-bit mask
+    compression = COMPRESSIONS[compression]
+    level = level or DEFAULT_LEVELS[compression]
+    dtype = image.dtype
+    samples = image.shape[2]
+    bgr = bgr and samples in (3, 4)
+    mask = False
+    if compression == COMPRESSION_ZSTD and zstandard is None:
+        raise ValueError("ZSTD needs the zstandard package")
+    if compression == COMPRESSION_JPEG:
+        if dtype != np.uint8 or not bgr:
+            raise ValueError("JPEG needs an 8-bit BGR(A) image")
+        mask = samples == 4
+        samples = 3
+    predictor = compression in (COMPRESSION_DEFLATE, COMPRESSION_ZSTD) and dtype.kind in "ui"
+    photometric = 6 if compression == COMPRESSION_JPEG else 2 if bgr else 1   # YCbCr, RGB, BlackIsZero
+    # The IFDs of the image, its mask, and of the overviews, with the tiles of each
+    ifds = []
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for overview, array in enumerate(pyramid(image, tile_size if overviews else max(image.shape))):
+            rows, cols = array.shape[:2]
+            tiles = []
+            masks = []
+            for row in range(0, rows, tile_size):
+                band = np.zeros(shape=(tile_size, cols + -cols % tile_size, array.shape[2]), dtype=dtype)
+                band[:min(tile_size, rows - row), :cols] = array[row:row + tile_size]
+                blocks = [band[:, col:col + tile_size] for col in range(0, cols, tile_size)]
+                if bgr and compression != COMPRESSION_JPEG:
+                    blocks = [block[:, :, [2, 1, 0, 3][:samples]] for block in blocks]
+                tiles += executor.map(lambda block: encode_tile(block[:, :, :samples], compression, level,
+                                                                predictor), blocks)
+                if mask and overview == 0:
+                    masks += executor.map(lambda block: zlib.compress(np.packbits(block[:, :, 3] > 0, axis=1)
+                                                                      .tobytes(), 6), blocks)
+            tags = [
+                (256, LONG, [cols]),                                    # ImageWidth
+                (257, LONG, [rows]),                                    # ImageLength
+                (258, SHORT, [dtype.itemsize * 8] * samples),           # BitsPerSample
+                (259, SHORT, [compression]),                            # Compression
+                (262, SHORT, [photometric]),                            # PhotometricInterpretation
+                (277, SHORT, [samples]),                                # SamplesPerPixel
+                (284, SHORT, [1]),                                      # PlanarConfiguration: chunky
+                (322, LONG, [tile_size]),                               # TileWidth
+                (323, LONG, [tile_size]),                               # TileLength
+                (339, SHORT, [sample_format(dtype)] * samples),         # SampleFormat
+            ]
+            if overview > 0:
+                tags.append((254, LONG, [1]))                           # NewSubfileType: reduced resolution
+            elif gsd > 0:
+                tags += geo_tags(boundary, gsd, epsg)
+            if predictor:
+                tags.append((317, SHORT, [2]))                          # Predictor: horizontal differencing
+            if compression == COMPRESSION_JPEG:
+                tags.append((530, SHORT, [2, 2]))                       # YCbCrSubSampling of OpenCV
+            elif samples > (3 if bgr else 1):
+                # ExtraSamples: the last one is the unassociated alpha
+                tags.append((338, SHORT, [0] * (samples - (3 if bgr else 1) - 1) + [2]))
+            ifds.append((tags, tiles))
+            if masks:
+                ifds.append(([
+                    (254, LONG, [4]),                                   # NewSubfileType: transparency mask
+                    (256, LONG, [cols]),
+                    (257, LONG, [rows]),
+                    (258, SHORT, [1]),
+                    (259, SHORT, [COMPRESSION_DEFLATE]),
+                    (262, SHORT, [4]),                                  # PhotometricInterpretation: mask
+                    (277, SHORT, [1]),
+                    (284, SHORT, [1]),
+                    (322, LONG, [tile_size]),
+                    (323, LONG, [tile_size]),
+                ], masks))
+
+    bigtiff = sum(len(tile) for _, tiles in ifds for tile in tiles) > 2 ** 32 - 2 ** 24
+    offset_type = LONG8 if bigtiff else LONG
+    for tags, tiles in ifds:
+        tags += [(324, offset_type, [0] * len(tiles)),                  # TileOffsets
+                 (325, offset_type, [len(tile) for tile in tiles])]     # TileByteCounts
+    # The offsets of the IFDs after the header, and of the tiles after them, the overviews first
+    ifd_offsets = [16 if bigtiff else 8]
+    for tags, _ in ifds:
+        ifd_offsets.append(ifd_offsets[-1] + len(pack_ifd(tags, bigtiff, 0)))
+    offset = ifd_offsets[-1]
+    for tags, tiles in reversed(ifds):
+        offsets = tags[-2][2]
+        for i, tile in enumerate(tiles):
+            offsets[i] = offset
+            offset += len(tile)
+
+    with open(path, "wb") as f:
+        if bigtiff:
+            f.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, ifd_offsets[0]))
+        else:
+            f.write(b"II" + struct.pack("<HI", 42, ifd_offsets[0]))
+        for i, (tags, _) in enumerate(ifds):
+            f.write(pack_ifd(tags, bigtiff, ifd_offsets[i], ifd_offsets[i + 1] if i + 1 < len(ifds) else 0))
+        for _, tiles in reversed(ifds):
+            for tile in tiles:
+                f.write(tile)
+
+
+if __name__ == "__main__":
+    # A multispectral frame of odd size, 5 bands and the alpha, through the overviews and the lossless compressions
+    import tempfile
+    image = np.random.randint(0, 2 ** 16, size=(601, 701, 6), dtype=np.uint16)
+    levels = pyramid(image, 256)
+    for finer, level in zip(levels, levels[1:]):
+        bands = [cv2.resize(band, level.shape[1::-1], interpolation=cv2.INTER_AREA) for band in np.moveaxis(finer, 2, 0)]
+        assert np.array_equal(level, np.stack(bands, axis=2))
+    with tempfile.TemporaryDirectory() as directory:
+        for compression in ["deflate", "none"] + (["zstd"] if zstandard is not None else []):
+            write_geotiff(os.path.join(directory, compression + ".tif"), image, compression=compression, bgr=False)
+    print(f"Overviews {[level.shape for level in levels]}, written in deflate, none and zstd if installed")
@@ -1,6 +1,7 @@
 from config import config
 from collections import deque
 import time
+import atexit
 import numpy as np
 from pathlib import Path
 import Metashape
@@ -9,9 +10,10 @@ from rich.console import Console
 from rich.table import Table
 from rich.progress import track
 
-from processing import orthophoto_dg, orthophoto_lba
+from processing import orthophoto_dg, orthophoto_lba, OrthophotoWriter, Prefetcher
 from module import nparray2las
-from rectification import create_pnga_optical
+from rectification import warmup
+from dem import TiledDEM, LabelCache, start_csf_workers
 
 console = Console()
 
@@ -51,18 +53,85 @@ diff_init_esti = config["diff_init_esti"]
 # std_init_esti = config["std_init_esti"]
 diff_before_current = config["diff_before_current"]
 
+csf_params = {
+    "slope_smooth": config["slope_smooth"],
+    "cloth_resolution": config["cloth_resolution"],
+    "rigidness": config["rigidness"],
+    "iterations": config["iterations"],
+    "class_threshold": config["class_threshold"],
+    "time_step": config["time_step"],
+    "tile_size": config["csf_tile_size"],
+    "overlap": config["csf_overlap"],
+    "workers": config["csf_workers"],
+}
+
+# The processes of the tiled CSF, forked before the kernels and the threads below start
+start_csf_workers(csf_params["workers"])
+
+use_label_cache = config["label_cache"]
+label_voxel_size = config["label_voxel_size"]
+label_max_age = config["label_max_age"]
+
 epsg = config["epsg"]
 gsd = config["gsd"]
 dem = config["dem"]
+plane_tolerance = config["plane_tolerance"]
+object_height = config["object_height"]
+object_ratio = config["object_ratio"]
+dem_interpolation = config["dem_interpolation"]
+dem_resolution = config["dem_resolution"]
+dem_statistic = config["dem_statistic"]
+voxel_size = config["voxel_size"]
+point_budget = config["point_budget"]
+dem_incremental = config["dem_incremental"]
+dem_tile_size = config["dem_tile_size"]
+dem_store = config["dem_store"]
+dem_coverage = config["dem_coverage"]
+dem_margin = config["dem_margin"]
 ground_height = config["ground_height"]
+plane_engine = config["plane_engine"]
+resampling = config["resampling"]
+strip_rows = config["strip_rows"]
+max_frame_pixels = config["max_frame_pixels"]
+true_ortho = config["true_ortho"]
+occlusion_tolerance = config["occlusion_tolerance"]
+precision = config["precision"]
+max_decode_scale = config["max_decode_scale"]
+prefetch_depth = config["prefetch_depth"]
+write_queue = config["write_queue"]
+encoder = config["encoder"]
+encoder_candidates = config["encoder_candidates"]
+encoder_seconds = config["encoder_seconds"]
+encoder_ratio = config["encoder_ratio"]
+compression_workers = config["compression_workers"]
 
 console.log(config)
 
+# Compile the rectification kernels, or load them from the cache, before the first frame
+console.print(f"Warmup time: {warmup():.2f} sec", style="blink bold red underline")
+
 images = Path(image_path).glob('*.' + extension)
 images = [str(x) for x in images if x.is_file()]
 images.sort()
 images_to_process = deque(maxlen=no_images_process)
 
+# The DEM of the frames processed by LBA, on the resolution of the config, or of the first frame if 0
+# Its tiles are kept in dem_store by EPSG, for the flights after over the same site
+tiled_dem = TiledDEM(dem_resolution if dem_resolution > 0 else gsd, dem_tile_size, path=dem_store,
+                     epsg=epsg) if dem_incremental else None
+
+# The labels of the points of the frames processed by LBA
+label_cache = LabelCache(label_voxel_size, label_max_age, csf_params["overlap"]) if use_label_cache else None
+
+# The writer of the orthophotos, flushed on exit even if the loop breaks or raises
+writer = OrthophotoWriter(write_queue, encoder, compression_workers, encoder_candidates, encoder_seconds,
+                          encoder_ratio)
+atexit.register(writer.close)
+
+# The loader of the next images, ahead of the frame in process
+prefetcher = Prefetcher(prefetch_depth)
+atexit.register(prefetcher.close)
+
 poses_stack = np.zeros(shape=(0, 4, 4))
 points_stack = np.zeros((0, 3))
 colors_stack = np.zeros((0, 3))
@@ -76,6 +145,7 @@ for i in track(range(len(images))):
     table = Table(show_header=True, header_style="bold magenta")
     table.add_column("Image", style="dim")
     table.add_column("Output", style="dim")
+    prefetcher.schedule(images[i + 1:i + 1 + prefetch_depth], images[i])
     try:
         ### 1. Georeferencing
         images_to_process.append(images[i])
@@ -83,31 +153,64 @@ for i in track(range(len(images))):
         table.add_row(image, dst)
         console.print(table)
         if i < no_images_process - 1:
-            b, g, r, a, bbox, gsd, times = orthophoto_dg(image_path=images[i], metadata_in_image=metadata_in_image,
+            orthophoto, bbox, gsd, times = orthophoto_dg(image_path=images[i], metadata_in_image=metadata_in_image,
                                                          sys_cal=sys_cal, epsg=epsg,
-                                                         gsd=gsd, ground_height=ground_height)
+                                                         gsd=gsd, ground_height=ground_height,
+                                                         plane_engine=plane_engine, resampling=resampling,
+                                                         dst=dst, strip_rows=strip_rows,
+                                                         max_frame_pixels=max_frame_pixels, precision=precision,
+                                                         tiled_dem=tiled_dem, dem_margin=dem_margin,
+                                                         dem_statistic=dem_statistic, dem_coverage=dem_coverage,
+                                                         max_decode_scale=max_decode_scale,
+                                                         prefetcher=prefetcher)
         else:
-            b, g, r, a, bbox, gsd, times, flag = orthophoto_lba(image_path=image, metadata_in_image=metadata_in_image,
+            orthophoto, bbox, gsd, times, flag = orthophoto_lba(image_path=image, metadata_in_image=metadata_in_image,
                                                                 sys_cal=sys_cal, flag=flag, types=types,
                                                                 matching_accuracy=matching_accuracy,
                                                                 diff_init_esti=diff_init_esti,
-                                                                epsg=epsg, gsd=gsd, output_path=output_path)
+                                                                epsg=epsg, gsd=gsd, output_path=output_path,
+                                                                resampling=resampling, true_ortho=true_ortho,
+                                                                occlusion_tolerance=occlusion_tolerance,
+                                                                precision=precision,
+                                                                dem_interpolation=dem_interpolation,
+                                                                dem_statistic=dem_statistic,
+                                                                tiled_dem=tiled_dem, dem_margin=dem_margin,
+                                                                dem_resolution=dem_resolution,
+                                                                csf_params=csf_params, label_cache=label_cache,
+                                                                surface=dem, voxel_size=voxel_size,
+                                                                point_budget=point_budget,
+                                                                plane_engine=plane_engine,
+                                                                plane_tolerance=plane_tolerance,
+                                                                object_height=object_height,
+                                                                object_ratio=object_ratio,
+                                                                dem_coverage=dem_coverage,
+                                                                max_decode_scale=max_decode_scale,
+                                                                prefetcher=prefetcher)
         ### (4. Write the Orthophoto)
         write_start = time.time()
-        create_pnga_optical(b, g, r, a, bbox, gsd, epsg, dst)
-        write_time = time.time() - write_start
+        if orthophoto is not None:     # not streamed already
+            writer.write(orthophoto, bbox, gsd, epsg, dst)
+        write_time = time.time() - write_start  # the wait for the writer, if in a thread
         console.print(f"Write time: {write_time:.2f} sec", style="blink bold red underline")
 
     except Exception as e:
         console.print(f" *** {e}", style="blink bold red underline")
-        b, g, r, a, bbox, gsd, times = orthophoto_dg(image_path=images[i], metadata_in_image=metadata_in_image,
+        orthophoto, bbox, gsd, times = orthophoto_dg(image_path=images[i], metadata_in_image=metadata_in_image,
                                                      sys_cal=sys_cal, epsg=epsg,
-                                                     gsd=gsd, ground_height=ground_height)
+                                                     gsd=gsd, ground_height=ground_height,
+                                                     plane_engine=plane_engine, resampling=resampling,
+                                                     dst=dst, strip_rows=strip_rows,
+                                                     max_frame_pixels=max_frame_pixels, precision=precision,
+                                                     tiled_dem=tiled_dem, dem_margin=dem_margin,
+                                                     dem_statistic=dem_statistic, dem_coverage=dem_coverage,
+                                                     max_decode_scale=max_decode_scale,
+                                                     prefetcher=prefetcher)
 
         ### (4. Write the Orthophoto)
         write_start = time.time()
-        create_pnga_optical(b, g, r, a, bbox, gsd, epsg, dst)
-        write_time = time.time() - write_start
+        if orthophoto is not None:     # not streamed already
+            writer.write(orthophoto, bbox, gsd, epsg, dst)
+        write_time = time.time() - write_start  # the wait for the writer, if in a thread
         console.print(f"Write time: {write_time:.2f} sec", style="blink bold red underline")
         flag = False
     except KeyboardInterrupt:
@@ -137,6 +240,9 @@ for i in track(range(len(images))):
     )
     console.print(table)
 
+writer.close()
+prefetcher.close()
+
 print("==============================================")
 print(" *** Elapsed time: %.2f" % (time.time() - start_time))
 print("==============================================")
@@ -1,21 +1,248 @@
 from georeferencing import solve_direct_georeferencing, solve_lba_first, solve_lba_esti_div, solve_lba_init_uni, solve_lba_esti_uni
-from dem import boundary, generate_dem
+from georeferencing import eo_sidecars, eo_sidecar, read_eo_sidecar
+from dem import boundary, fill_holes, footprint, generate_dem, ground_points, read_points, relief
 from module import Rot3D, las2nparray, nparray2las
 from rectification import *
+from encoders import encode_optical, select_encoder
 
 from rich.console import Console
 import time
+import logging
+import queue
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 console = Console()
 
 
-def orthophoto_dg(image_path, metadata_in_image, sys_cal, epsg=5186, gsd=0, ground_height=0):
+class OrthophotoWriter:
+    # Encode and write the orthophotos in a thread, so that the write of a frame overlaps with the next frame
+    # The queue holds max_pending frames at most, then the main loop waits for the disk (0: write in the main loop)
+    # The orthophotos are released to the buffer pool once written
+    # With the encoder "auto", the first orthophoto selects one of candidates for the run (select_encoder)
+    def __init__(self, max_pending=2, encoder="png", workers=0, candidates=(), seconds=1., ratio=0):
+        self.encoder = encoder  # of encode_optical
+        self.workers = workers
+        self.candidates = candidates
+        self.seconds = seconds
+        self.ratio = ratio
+        self.queue = queue.Queue(maxsize=max_pending) if max_pending > 0 else None
+        self.thread = None
+        if self.queue is not None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def write(self, orthophoto, bbox, gsd, epsg, dst):
+        if self.queue is None:
+            self.encode(orthophoto, bbox, gsd, epsg, dst)
+            buffer_pool.release(orthophoto)
+        else:
+            self.queue.put((orthophoto, bbox, gsd, epsg, dst))   # blocks while the queue is full
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            orthophoto, bbox, gsd, epsg, dst = job
+            encode_start = time.time()
+            try:
+                self.encode(orthophoto, bbox, gsd, epsg, dst)
+                console.print(f"Encode time: {time.time() - encode_start:.2f} sec ({dst})",
+                              style="blink bold red underline")
+            except Exception as e:
+                console.print(f" *** Write {dst}: {e}", style="blink bold red underline")
+            buffer_pool.release(orthophoto)
+
+    def encode(self, orthophoto, bbox, gsd, epsg, dst):
+        if self.encoder == "auto":
+            # Selected once for the run, PNG (TIFF for what it can't hold) if no candidate encodes the orthophoto
+            try:
+                self.encoder, results = select_encoder(orthophoto, self.candidates, self.seconds, self.ratio,
+                                                       self.workers)
+            except ValueError:
+                self.encoder, results = "png", []
+            for encoder, seconds, size in results:
+                console.print(f"Encoder {encoder}: {seconds:.2f} sec, {size / orthophoto.nbytes:.1%} of raw")
+            console.print(f"Encoder: {self.encoder}", style="blink bold red underline")
+        encode_optical(orthophoto, bbox, gsd, epsg, dst, self.encoder, self.workers)
+
+    def close(self):
+        # Flush the frames in the queue, and stop the thread
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class Prefetcher:
+    # Decode the next images and parse their EO sidecars in threads, while the main loop works on a frame
+    # At most depth images are loaded ahead, at the decode scale of the last frame, and taken by path
+    def __init__(self, depth=2):
+        self.executor = ThreadPoolExecutor(max_workers=depth) if depth > 0 else None
+        self.depth = depth
+        self.scale = 1
+        self.pending = {}   # path -> future of (scale, image)
+
+    def schedule(self, paths, current=None):
+        # Load the first depth of paths, the images after the current one,
+        # and forget the others loaded before but the current one, loaded ahead by the last schedule
+        if self.executor is None:
+            return
+        paths = paths[:self.depth]
+        for path in [path for path in self.pending if path not in paths and path != current]:
+            self.discard(path)
+        for path in paths:
+            if path not in self.pending:
+                self.pending[path] = self.executor.submit(self.load, path, self.scale)
+
+    def discard(self, path):
+        # Cancel the load of a path and evict its sidecar, also when the load is already running
+        future = self.pending.pop(path)
+        if not future.cancel():
+            future.add_done_callback(lambda _: eo_sidecars.pop(path, None))
+        eo_sidecars.pop(path, None)
+
+    def load(self, path, scale):
+        if Path(eo_sidecar(path)).exists():
+            eo_sidecars[path] = read_eo_sidecar(path)
+        return scale, decode_image(path, scale)
+
+    def take(self, path, scale):
+        # The image of a path decoded at scale, None if it isn't loaded at it
+        self.scale = scale
+        future = self.pending.pop(path, None)
+        if future is None:
+            return None
+        loaded_scale, image = future.result()
+        eo_sidecars.pop(path, None)     # read already by the georeferencing, if not taken from here
+        return image if loaded_scale == scale else None
+
+    def close(self):
+        if self.executor is not None:
+            self.schedule([])
+            self.executor.shutdown(wait=True)
+
+
+def decode_scale(gsd, native_gsd, max_scale=8):
+    # The largest of 1, 2, 4 and 8 up to max_scale, by which the pixels of an image are still no coarser than gsd
+    scale = 1
+    while scale * 2 <= max_scale and native_gsd * scale * 2 <= gsd * (1 + 1e-9):
+        scale *= 2
+    return scale
+
+
+def jpeg_components(image_path):
+    # The number of components of a JPEG in its start of frame, 3 if not found
+    with open(image_path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return 3
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or marker[0] != 0xff:
+                return 3
+            if marker[1] in (0x01, 0xff) or 0xd0 <= marker[1] <= 0xd7:   # no length, or fill bytes
+                f.seek(-1 if marker[1] == 0xff else 0, 1)
+                continue
+            length = int.from_bytes(f.read(2), "big")
+            if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+                segment = f.read(6)
+                return segment[5] if len(segment) == 6 else 3
+            f.seek(length - 2, 1)
+
+
+def decode_image(image_path, scale=1):
+    # A JPEG of scale 2, 4 or 8 is decoded at 1/scale of its size by the DCT scaling of libjpeg,
+    # without EXIF orientation and in the channels of an unchanged decode of it, gray or BGR
+    if scale > 1 and Path(image_path).suffix.lower() in (".jpg", ".jpeg"):
+        if jpeg_components(image_path) == 1:
+            reduced = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                       8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+        else:
+            reduced = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+        image = cv2.imread(image_path, reduced[scale] | cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        image = cv2.imread(image_path, -1)
+
+    return image.reshape(image.shape[0], image.shape[1], -1)  # channels of any number and dtype, as they are
+
+
+def read_image(image_path, pixel_size, calibration, scale=1, prefetcher=None):
+    # An image, from the prefetcher if loaded there, and its pixel size and calibration (f, cx, cy, b1, b2 in px)
+    image = prefetcher.take(image_path, scale) if prefetcher is not None else None
+    if image is None:
+        image = decode_image(image_path, scale)
+    if scale > 1 and Path(image_path).suffix.lower() in (".jpg", ".jpeg"):
+        pixel_size = pixel_size * scale
+        if calibration is not None:
+            calibration = calibration.copy()
+            calibration[:5] /= scale
+        console.print(f"Decoded at 1/{scale}: {image.shape[1]} x {image.shape[0]} px",
+                      style="blink bold red underline")
+
+    return image, pixel_size, calibration
+
+
+def orthophoto_on_dem(image, eo, R, focal_length, pixel_size, gsd, dem, margin, distortion, true_ortho=False,
+                      occlusion_tolerance=0.5, precision="float64", resampling="nearest"):
+    # The orthophoto from the upper-left node of the DEM on the GSD, with its heights sampled from the DEM
+    dem_rows, dem_cols = dem.z.shape
+    boundary_rows = int((dem_rows - 1) * dem.gsd / gsd + 1e-6) + 1
+    boundary_cols = int((dem_cols - 1) * dem.gsd / gsd + 1e-6) + 1
+    bbox = np.array([dem.x_min, dem.x_min + (boundary_cols - 1) * gsd,
+                     dem.y_max - (boundary_rows - 1) * gsd, dem.y_max])
+    # The footprint on the DEM lies within the hull of the footprints on its lowest and highest planes
+    polygon = np.hstack((footprint(image, eo, R, np.nanmin(dem.z), pixel_size, focal_length, 1 + margin),
+                         footprint(image, eo, R, np.nanmax(dem.z), pixel_size, focal_length, 1 + margin)))
+    spans = footprint_spans(polygon, dem.x_min, dem.y_max, gsd, boundary_rows, boundary_cols)
+    if true_ortho:
+        # The depth buffer of the cells of the DEM itself
+        dem_spans = footprint_spans(polygon, dem.x_min, dem.y_max, dem.gsd, dem_rows, dem_cols)
+        depth, depth_scale = zbuffer(dem.z, dem.x_min, dem.y_max, dem.gsd, eo, R, focal_length, pixel_size,
+                                     image.shape, dem_spans, distortion)
+    else:
+        depth, depth_scale = np.empty(shape=(0, 0), dtype=np.float32), 1
+    orthophoto = buffer_pool.acquire((boundary_rows, boundary_cols, image.shape[2] + 1), image.dtype)
+    rectify = rectify_dem_f32 if precision == "float32" else rectify_dem_parallel
+    rectify(dem.z, dem.geotransform, dem.x_min, dem.y_max, gsd, boundary_rows, boundary_cols, eo, R, focal_length,
+            pixel_size, image, spans, orthophoto, sample_alpha(image.dtype), distortion, depth, depth_scale,
+            occlusion_tolerance, resampling)
+
+    return orthophoto, bbox
+
+
+def stored_dem(tiled_dem, region, image, eo, R, pixel_size, focal_length, margin, statistic="mean", coverage=0.95,
+               stored_only=False):
+    # The patch of a tiled DEM over a region, if the cells of its points cover the footprint of the image on it,
+    # None otherwise. The cells filled by fill_holes don't count
+    if tiled_dem is None or tiled_dem.gsd == 0 or statistic == "median":
+        return None
+    dem = tiled_dem.patch(region[0], region[1], region[2], region[3], statistic, False, stored_only)
+    if np.all(np.isnan(dem.z)):
+        return None
+    polygon = np.hstack((footprint(image, eo, R, np.nanmin(dem.z), pixel_size, focal_length, 1 + margin),
+                         footprint(image, eo, R, np.nanmax(dem.z), pixel_size, focal_length, 1 + margin)))
+    spans = footprint_spans(polygon, dem.x_min, dem.y_max, dem.gsd, dem.z.shape[0], dem.z.shape[1])
+    cols = np.arange(dem.z.shape[1])
+    inside = (cols >= spans[:, 0:1]) & (cols < spans[:, 1:2])
+    if not np.any(inside) or np.mean(~np.isnan(dem.z[inside])) < coverage:
+        return None
+    dem.z = fill_holes(dem.z, dem.x_min, dem.y_max, dem.gsd)
+    return dem
+
+
+def orthophoto_dg(image_path, metadata_in_image, sys_cal, epsg=5186, gsd=0, ground_height=0, plane_engine="homography",
+                  resampling="nearest", dst=None, strip_rows=0, max_frame_pixels=0, precision="float64",
+                  tiled_dem=None, dem_margin=0.2, dem_statistic="mean", dem_coverage=0.95, max_decode_scale=8,
+                  prefetcher=None):
     ######################
     ### Georeferencing ###
     ######################
     ### 1. Georeferencing
     georef_start = time.time()
-    eo, focal_length, pixel_size, center_z = solve_direct_georeferencing(image_path, metadata_in_image, sys_cal, epsg)
+    eo, focal_length, pixel_size, center_z, calibration = solve_direct_georeferencing(image_path, metadata_in_image,
+                                                                                      sys_cal, epsg)
 
     R = Rot3D(eo * np.pi / 180)
     if gsd == 0:
@@ -33,8 +260,18 @@ def orthophoto_dg(image_path, metadata_in_image, sys_cal, epsg=5186, gsd=0, grou
     ###############
     ### 2. Extract boundary
     dem_start = time.time()
-    image = cv2.imread(image_path, -1)
-    bbox = boundary(image, eo, R, ground_height, pixel_size, focal_length)
+    # Decoded only as fine as the GSD needs
+    scale = decode_scale(gsd, (pixel_size * (eo[2] - ground_height)) / focal_length, max_decode_scale)
+    image, pixel_size, calibration = read_image(image_path, pixel_size, calibration, scale, prefetcher)
+    alpha = sample_alpha(image.dtype)
+    # The lens distortion of the sensor, and a margin of the pinhole footprint enclosing the distorted image
+    distortion, margin = distortion_table(calibration, image.shape, focal_length, pixel_size)
+    bbox = boundary(image, eo, R, ground_height, pixel_size, focal_length, margin)
+    # A DEM of the site from the flights before, if it covers the footprint
+    region = bbox.ravel().copy()
+    pad = dem_margin * max(region[1] - region[0], region[3] - region[2])
+    region += np.array([-pad, pad, -pad, pad])
+    dem = stored_dem(tiled_dem, region, image, eo, R, pixel_size, focal_length, margin, dem_statistic, dem_coverage)
     dem_time = time.time() - dem_start
     console.print(f"DEM time: {dem_time:.2f} sec", style="blink bold red underline")
 
@@ -42,19 +279,49 @@ def orthophoto_dg(image_path, metadata_in_image, sys_cal, epsg=5186, gsd=0, grou
     rectify_start = time.time()
     boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / gsd)
     boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / gsd)
-    b, g, r, a = rectify_plane_parallel(bbox, boundary_rows, boundary_cols, gsd, eo, ground_height,
-                                        R, focal_length, pixel_size, image)
+    polygon = footprint(image, eo, R, ground_height, pixel_size, focal_length, 1 + margin)
+    spans = footprint_spans(polygon, bbox[0, 0], bbox[3, 0], gsd, boundary_rows, boundary_cols)
+    if dem is not None:
+        console.print("Rectify on the stored DEM", style="blink bold red underline")
+        orthophoto, bbox = orthophoto_on_dem(image, eo, R, focal_length, pixel_size, gsd, dem, margin, distortion,
+                                             precision=precision, resampling=resampling)
+    elif dst is not None and strip_rows > 0 and boundary_rows * boundary_cols > max_frame_pixels:
+        # Stream a large orthophoto into a TIFF strip by strip, with the memory of one strip
+        console.print(f"Streaming {boundary_rows} x {boundary_cols} px by {strip_rows} rows",
+                      style="blink bold red underline")
+        strip = buffer_pool.acquire((min(strip_rows, boundary_rows), boundary_cols, image.shape[2] + 1), image.dtype)
+        strips = rectify_plane_strips(bbox, boundary_rows, boundary_cols, gsd, eo, ground_height,
+                                      R, focal_length, pixel_size, image, spans, strip, alpha, distortion,
+                                      resampling, plane_engine, precision)
+        create_tiff_optical(strips, boundary_rows, boundary_cols, bbox.ravel(), gsd, epsg, dst, strip.shape[0],
+                            strip.shape[2], strip.dtype)
+        buffer_pool.release(strip)
+        orthophoto = None   # already written
+    else:
+        orthophoto = buffer_pool.acquire((boundary_rows, boundary_cols, image.shape[2] + 1), image.dtype)
+        rectify = plane_rectifier(plane_engine, precision)
+        rectify(bbox, boundary_rows, boundary_cols, gsd, eo, ground_height,
+                R, focal_length, pixel_size, image, spans, orthophoto, alpha, distortion, resampling)
     bbox = bbox.ravel()  # for generating orthophoto
     rectify_time = time.time() - rectify_start
     console.print(f"Rectify time: {rectify_time:.2f} sec", style="blink bold red underline")
 
     times = np.array([georef_time, dem_time, rectify_time])
 
-    return b, g, r, a, bbox, gsd, times
+    return orthophoto, bbox, gsd, times
+
+
+# DEM times of the last frames on each surface, to log the time saved by the automatic choice of one
+dem_times = {"plane": deque(maxlen=10), "dtm": deque(maxlen=10), "dsm": deque(maxlen=10)}
 
 
 def orthophoto_lba(image_path, metadata_in_image, sys_cal, flag, types,
-                   matching_accuracy=2, diff_init_esti=10, epsg=5186, gsd=0, output_path="."):
+                   matching_accuracy=2, diff_init_esti=10, epsg=5186, gsd=0, output_path=".", resampling="nearest",
+                   true_ortho=False, occlusion_tolerance=0.5, precision="float64", dem_interpolation="raster",
+                   dem_statistic="mean", tiled_dem=None, dem_margin=0.2, dem_resolution=0, csf_params=None,
+                   label_cache=None, surface="auto", voxel_size=0, point_budget=0, plane_engine="homography",
+                   plane_tolerance=1., object_height=2., object_ratio=0.1, dem_coverage=0.95, max_decode_scale=8,
+                   prefetcher=None):
     ######################
     ### Georeferencing ###
     ######################
@@ -62,20 +329,24 @@ def orthophoto_lba(image_path, metadata_in_image, sys_cal, flag, types,
     georef_start = time.time()
     if not flag:        # solve_lba_first
         console.print(f"solve_lba_first", style="blink bold red underline")
-        eo, focal_length, pixel_size, center_z = solve_lba_first(image_path,    # multiple images
-                                                                 metadata_in_image, sys_cal,
-                                                                 epsg, matching_accuracy, diff_init_esti, output_path)
+        eo, focal_length, pixel_size, center_z, calibration = solve_lba_first(image_path,    # multiple images
+                                                                              metadata_in_image, sys_cal, epsg,
+                                                                              matching_accuracy, diff_init_esti,
+                                                                              output_path)
     elif flag and types == "fixed":        # solve_lba_esti_div, need to be modified
         console.print(f"solve_lba_esti_div", style="blink bold red underline")
-        eo, focal_length, pixel_size, center_z = solve_lba_esti_div(image_path, epsg, matching_accuracy)
+        eo, focal_length, pixel_size, center_z, calibration = solve_lba_esti_div(image_path, epsg,
+                                                                                 matching_accuracy)
     elif flag and types == "nonfixed-initial":        # solve_lba_init_uni, need to be modified
         console.print(f"solve_lba_init_uni", style="blink bold red underline")
-        eo, focal_length, pixel_size, center_z = solve_lba_init_uni(image_path, epsg, matching_accuracy)
+        eo, focal_length, pixel_size, center_z, calibration = solve_lba_init_uni(image_path, epsg,
+                                                                                 matching_accuracy)
     elif flag and types == "nonfixed-estimated":        # solve_lba_esti_uni
         console.print(f"solve_lba_esti_uni", style="blink bold red underline")
-        eo, focal_length, pixel_size, center_z = solve_lba_esti_uni(image_path, # one image
-                                                                    metadata_in_image, sys_cal,
-                                                                    epsg, matching_accuracy, diff_init_esti, output_path)
+        eo, focal_length, pixel_size, center_z, calibration = solve_lba_esti_uni(image_path, # one image
+                                                                                 metadata_in_image, sys_cal, epsg,
+                                                                                 matching_accuracy, diff_init_esti,
+                                                                                 output_path)
     else:
         console.print(f"Which type of processing you have?", style="blink bold red underline")
         return
@@ -96,24 +367,112 @@ def orthophoto_lba(image_path, metadata_in_image, sys_cal, flag, types,
     ###############
     ### 2. DEM processing
     dem_start = time.time()
-    dem_x, dem_y, dem_z, bbox = generate_dem("pointclouds.pcd", gsd)
+    # Decoded only as fine as the GSD needs, in the DEM time as in orthophoto_dg, for the footprint of the image
+    scale = decode_scale(gsd, (pixel_size * (eo[2] - center_z)) / focal_length, max_decode_scale)
+    image, pixel_size, calibration = read_image(image_path.split()[-1], pixel_size, calibration, scale,
+                                                prefetcher)
+    distortion, margin = distortion_table(calibration, image.shape, focal_length, pixel_size)
+    # Only the points around the footprint of the image matter, the rest of the window is cropped before filtering
+    # The footprint is on the plane of the center of the points, with a margin of its size for the relief
+    region = boundary(image, eo, R, center_z, pixel_size, focal_length, margin).ravel()
+    pad = dem_margin * max(region[1] - region[0], region[3] - region[2])
+    region += np.array([-pad, pad, -pad, pad])
+    # A DEM of the site from the flights before, if it covers the footprint, saves the points
+    # Only of the tiles on disk not touched by this run, whose frames fold their fresh points in instead
+    dem = None
+    if surface in ("auto", "dtm") and tiled_dem is not None and tiled_dem.path:
+        dem = stored_dem(tiled_dem, region, image, eo, R, pixel_size, focal_length, margin, dem_statistic,
+                         dem_coverage, stored_only=True)
+    if dem is not None:
+        console.print("DEM from the store", style="blink bold red underline")
+        surface = "dtm"
+    else:
+        xyz = read_points("pointclouds.pcd", region)
+    chosen = surface == "auto"
+    if chosen:
+        # A plane if its relief displacement at the edge of the footprint is within plane_tolerance (unit: GSD),
+        # a DSM if objects rise in more than object_ratio of the cells, a DTM otherwise
+        height, spread, objects = relief(xyz, object_height=object_height)
+        corners = footprint(image, eo, R, height, pixel_size, focal_length, 1 + margin)
+        radius = np.max(np.hypot(corners[0] - eo[0], corners[1] - eo[1]))
+        displacement = spread * radius / (eo[2] - height) / gsd
+        if displacement <= plane_tolerance:
+            surface = "plane"
+        elif objects > object_ratio:
+            surface = "dsm"
+        else:
+            surface = "dtm"
+    # The DEM on a grid of its own, coarser than the orthophoto as the tie points can't support its GSD
+    dem_gsd = dem_resolution if dem_resolution > 0 else gsd
+    if dem is not None:
+        pass
+    elif surface == "plane":
+        # A plane on the median height of the points, without DEM
+        ground_height = np.median(xyz[:, 2])
+    elif tiled_dem is not None and surface == "dtm":
+        # Fold the ground points new to the DEM in, and take its patch under the footprint of the image
+        # The tiled DEM is of the ground, a DSM is generated on its own
+        # Only the rasterization is incremental here, the classification of the points is with label_cache
+        if tiled_dem.gsd == 0:
+            tiled_dem.gsd = dem_gsd
+        ground = ground_points(xyz, csf_params, label_cache, surface, voxel_size, point_budget)
+        console.print(f"New ground points: {tiled_dem.add(ground)} / {ground.shape[0]}")
+        if ground.shape[0] == 0:
+            # No ground in the window, a plane on the median height of its points instead
+            console.print("No ground points, rectified on a plane", style="blink bold red underline")
+            surface = "plane"
+            ground_height = np.median(xyz[:, 2]) if xyz.shape[0] > 0 else center_z
+        else:
+            polygon = np.hstack((footprint(image, eo, R, ground[:, 2].min(), pixel_size, focal_length, 1 + margin),
+                                 footprint(image, eo, R, ground[:, 2].max(), pixel_size, focal_length, 1 + margin)))
+            dem = tiled_dem.patch(polygon[0].min(), polygon[0].max(), polygon[1].min(), polygon[1].max(),
+                                  dem_statistic)
+    else:
+        dem = generate_dem(xyz, dem_gsd, dem_interpolation, dem_statistic, csf_params, label_cache, surface,
+                           voxel_size, point_budget)
     dem_time = time.time() - dem_start
     console.print(f"DEM time: {dem_time:.2f} sec", style="blink bold red underline")
+    if chosen:
+        # In my.log with the timings of the frames, by the logger of main_orthophoto (on the console too),
+        # with the DEM time saved over the mean of the last DTM frames
+        saved = ""
+        if surface != "dtm":
+            saved = f" saved {np.mean(dem_times['dtm']) - dem_time:.2f} s over a DTM of" \
+                    f" {np.mean(dem_times['dtm']):.2f} s of {len(dem_times['dtm'])} frames" \
+                    if dem_times["dtm"] else " saved unknown, no DTM frame yet"
+        logging.getLogger().info(f"{Path(image_path.split()[-1]).name} surface {surface} relief {spread:.2f} m"
+                                 f" ({displacement:.1f} GSD) objects {objects:.1%} dem {dem_time:.2f} s{saved}")
+    dem_times[surface].append(dem_time)
 
     ### 3. Geodata generation
     rectify_start = time.time()
-    boundary_rows = dem_x.shape[0]
-    boundary_cols = dem_x.shape[1]
-    image = cv2.imread(image_path.split()[-1], -1)
-    b, g, r, a = rectify_dem_parallel(dem_x, dem_y, dem_z, boundary_rows, boundary_cols,
-                                      eo, R, focal_length, pixel_size, image)
+    if surface == "plane":
+        bbox = boundary(image, eo, R, ground_height, pixel_size, focal_length, margin)
+        boundary_cols = int((bbox[1, 0] - bbox[0, 0]) / gsd)
+        boundary_rows = int((bbox[3, 0] - bbox[2, 0]) / gsd)
+        polygon = footprint(image, eo, R, ground_height, pixel_size, focal_length, 1 + margin)
+        spans = footprint_spans(polygon, bbox[0, 0], bbox[3, 0], gsd, boundary_rows, boundary_cols)
+        orthophoto = buffer_pool.acquire((boundary_rows, boundary_cols, image.shape[2] + 1), image.dtype)
+        rectify = plane_rectifier(plane_engine, precision)
+        rectify(bbox, boundary_rows, boundary_cols, gsd, eo, ground_height, R, focal_length, pixel_size, image,
+                spans, orthophoto, sample_alpha(image.dtype), distortion, resampling)
+        rectify_time = time.time() - rectify_start
+        console.print(f"Rectify time: {rectify_time:.2f} sec", style="blink bold red underline")
+
+        flag = True
+        times = np.array([georef_time, dem_time, rectify_time])
+
+        return orthophoto, bbox.ravel(), gsd, times, flag
+
+    orthophoto, bbox = orthophoto_on_dem(image, eo, R, focal_length, pixel_size, gsd, dem, margin, distortion,
+                                         true_ortho, occlusion_tolerance, precision, resampling)
     rectify_time = time.time() - rectify_start
     console.print(f"Rectify time: {rectify_time:.2f} sec", style="blink bold red underline")
 
     flag = True
     times = np.array([georef_time, dem_time, rectify_time])
 
-    return b, g, r, a, bbox, gsd, times, flag
+    return orthophoto, bbox, gsd, times, flag
 
     # # Import las to numpy array
     # points, colors = las2nparray(file_path="pointclouds.las")